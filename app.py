@@ -1,8 +1,12 @@
 import sqlite3
 import json
-from flask import Flask, render_template, request, jsonify, g
+from flask import Flask, render_template, request, jsonify, g, make_response, Response, send_file
 from datetime import datetime
 import os
+import re
+import time
+import hashlib
+import threading
 
 app = Flask(__name__)
 app.secret_key = 'super_secret_dev_key_123' # Required for session
@@ -26,6 +30,8 @@ def close_connection(exception):
 def init_db():
     with app.app_context():
         db = get_db()
+        # WAL lets readers (and backups) run alongside a writer. The setting is stored in the DB file.
+        db.execute("PRAGMA journal_mode=WAL")
         # Create Tables
         db.executescript('''
             CREATE TABLE IF NOT EXISTS users (
@@ -69,6 +75,7 @@ def init_db():
                 arrival_time TEXT NOT NULL,
                 travel_date TEXT NOT NULL,
                 price REAL NOT NULL,
+                status TEXT DEFAULT 'active', -- active / CANCELLED
                 FOREIGN KEY (bus_id) REFERENCES buses (id),
                 FOREIGN KEY (route_id) REFERENCES routes (id)
             );
@@ -78,13 +85,70 @@ def init_db():
                 user_id INTEGER NOT NULL,
                 schedule_id INTEGER NOT NULL,
                 seats TEXT NOT NULL, -- JSON list of seat numbers
-                passengers TEXT, -- JSON list of passenger details
+                passengers TEXT, -- Legacy JSON list of passenger details, see passengers table
                 total_amount REAL NOT NULL,
                 status TEXT DEFAULT 'confirmed',
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (user_id) REFERENCES users (id),
                 FOREIGN KEY (schedule_id) REFERENCES schedules (id)
             );
+
+            CREATE TABLE IF NOT EXISTS passengers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                booking_id INTEGER NOT NULL,
+                seat TEXT NOT NULL,
+                name TEXT NOT NULL,
+                age INTEGER,
+                gender TEXT,
+                contact TEXT, -- Phone, or email if no phone was given
+                FOREIGN KEY (booking_id) REFERENCES bookings (id)
+            );
+            CREATE INDEX IF NOT EXISTS idx_passengers_booking ON passengers (booking_id);
+            CREATE INDEX IF NOT EXISTS idx_passengers_contact ON passengers (contact);
+
+            -- Materialized per-route-per-date summary behind /api/fare-calendar
+            CREATE TABLE IF NOT EXISTS fare_calendar (
+                route_id INTEGER NOT NULL,
+                travel_date TEXT NOT NULL,
+                min_price REAL NOT NULL,
+                departures INTEGER NOT NULL,
+                seats_left INTEGER NOT NULL,
+                PRIMARY KEY (route_id, travel_date)
+            ) WITHOUT ROWID;
+
+            CREATE TABLE IF NOT EXISTS waitlist (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, -- FIFO order
+                schedule_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                seats_requested INTEGER NOT NULL,
+                passengers TEXT, -- JSON passenger details, copied to the passengers table on promotion
+                status TEXT DEFAULT 'waiting', -- waiting / promoted / left / cancelled (departure cancelled)
+                booking_id INTEGER, -- Set once promoted
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (schedule_id) REFERENCES schedules (id),
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            );
+            CREATE INDEX IF NOT EXISTS idx_waitlist_queue ON waitlist (schedule_id, status, id);
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_waitlist_one_per_user ON waitlist (schedule_id, user_id) WHERE status = 'waiting';
+
+            CREATE TABLE IF NOT EXISTS booking_groups (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                total_amount REAL NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            );
+
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                user_id INTEGER NOT NULL,
+                idem_key TEXT NOT NULL,
+                request_hash TEXT NOT NULL,
+                status_code INTEGER, -- NULL while the original request is in flight
+                response_body TEXT,
+                created_at TIMESTAMP NOT NULL,
+                PRIMARY KEY (user_id, idem_key)
+            );
+            CREATE INDEX IF NOT EXISTS idx_idempotency_created ON idempotency_keys (created_at);
         ''')
         
         # Migration 1: Check if otp_code exists in users (for existing DBs)
@@ -115,9 +179,424 @@ def init_db():
         except sqlite3.OperationalError:
             print("Migrating DB: Adding is_admin column...")
             db.execute("ALTER TABLE users ADD COLUMN is_admin INTEGER DEFAULT 0")
+
+        # Migration 5: Check if group_id exists in bookings
+        try:
+            db.execute("SELECT group_id FROM bookings LIMIT 1")
+        except sqlite3.OperationalError:
+            print("Migrating DB: Adding group_id column...")
+            db.execute("ALTER TABLE bookings ADD COLUMN group_id INTEGER")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_bookings_group ON bookings (group_id)")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_bookings_schedule ON bookings (schedule_id)")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_schedules_date ON schedules (travel_date)")
+
+        # Migration 6: Backfill passengers table from the legacy JSON column
+        cur = db.execute('''
+            SELECT id, passengers FROM bookings
+            WHERE passengers IS NOT NULL
+              AND NOT EXISTS (SELECT 1 FROM passengers p WHERE p.booking_id = bookings.id)
+        ''')
+        rows = []
+        for row in cur.fetchall():
+            try:
+                rows.extend(passenger_rows(row['id'], json.loads(row['passengers'])))
+            except (ValueError, TypeError, KeyError):
+                print(f"Skipping malformed passengers JSON on booking {row['id']}")
+        if rows:
+            print(f"Migrating DB: Backfilling {len(rows)} passengers...")
+            db.executemany(INSERT_PASSENGER_SQL, rows)
+
+        # Migration 7: Check if status exists in schedules (departures can be cancelled)
+        try:
+            db.execute("SELECT status FROM schedules LIMIT 1")
+        except sqlite3.OperationalError:
+            print("Migrating DB: Adding schedule status column...")
+            db.execute("ALTER TABLE schedules ADD COLUMN status TEXT DEFAULT 'active'")
+
+        # Migration 8: Populate the fare calendar for existing schedules
+        if db.execute("SELECT 1 FROM fare_calendar LIMIT 1").fetchone() is None:
+            print("Migrating DB: Building fare calendar...")
+            refresh_fare_calendar(db)
+
+        # Migration 9: Full-text index over bookings (needs SQLite built with FTS5)
+        try:
+            db.executescript(BOOKINGS_FTS_SCHEMA)
+            if db.execute("SELECT 1 FROM bookings_fts LIMIT 1").fetchone() is None and \
+               db.execute("SELECT 1 FROM bookings LIMIT 1").fetchone() is not None:
+                print("Migrating DB: Building bookings full-text index...")
+                db.execute(_FTS_ROW_SELECT.format(where=""))
+        except sqlite3.OperationalError as e:
+            print(f"Full-text search disabled: {e}")
         
         db.commit()
 
+# --- Passengers ---
+INSERT_PASSENGER_SQL = "INSERT INTO passengers (booking_id, seat, name, age, gender, contact) VALUES (?, ?, ?, ?, ?, ?)"
+
+def passenger_rows(booking_id, passengers):
+    # Map the booking form's passenger dicts onto passengers table rows
+    return [(booking_id, p['seat'], p['name'], p.get('age'), p.get('gender'),
+             p.get('contact') or p.get('phone') or p.get('email'))
+            for p in passengers or []]
+
+def fetch_passengers(db, booking_ids):
+    # {booking_id: [passenger, ...]} via the booking_id index
+    result = {bid: [] for bid in booking_ids}
+    if not booking_ids:
+        return result
+    placeholders = ','.join('?' * len(booking_ids))
+    cur = db.execute(f'''
+        SELECT booking_id, seat, name, age, gender, contact
+        FROM passengers WHERE booking_id IN ({placeholders})
+        ORDER BY booking_id, id
+    ''', list(booking_ids))
+    for row in cur.fetchall():
+        p = dict(row)
+        result[p.pop('booking_id')].append(p)
+    return result
+
+# --- Fare Calendar ---
+def refresh_fare_calendar(db, route_id=None, travel_date=None):
+    """Recompute fare_calendar rows for one route/date, one date, or everything.
+
+    Runs inside the caller's transaction so the summary commits with the change.
+    """
+    filters = [(col, val) for col, val in (("route_id", route_id), ("travel_date", travel_date)) if val is not None]
+    params = [val for _, val in filters]
+
+    def where(prefix="", extra=()):
+        conditions = list(extra) + [f"{prefix}{col} = ?" for col, _ in filters]
+        return ("WHERE " + " AND ".join(conditions)) if conditions else ""
+
+    db.execute(f"DELETE FROM fare_calendar {where()}", params)
+    db.execute(f'''
+        INSERT INTO fare_calendar (route_id, travel_date, min_price, departures, seats_left)
+        SELECT s.route_id, s.travel_date, MIN(s.price), COUNT(*),
+               SUM(MAX(b.total_seats - (SELECT COALESCE(SUM(json_array_length(bk.seats)), 0)
+                                        FROM bookings bk
+                                        WHERE bk.schedule_id = s.id AND bk.status = 'confirmed'), 0))
+        FROM schedules s
+        JOIN buses b ON s.bus_id = b.id
+        {where("s.", ["s.status != 'CANCELLED'"])}
+        GROUP BY s.route_id, s.travel_date
+    ''', params)
+
+# --- Booking Search (FTS5) ---
+# bookings_fts has one row per booking (rowid = booking id) holding the PNR, the
+# booker's name/email and all passenger names/contacts. Triggers rebuild a row
+# whenever the booking, its passengers or its user change.
+_FTS_ROW_SELECT = '''
+    INSERT INTO bookings_fts (rowid, pnr, user_name, user_email, passenger_names, passenger_contacts)
+    SELECT bk.id, 'AB-' || bk.id, u.name, u.email,
+           (SELECT group_concat(p.name, ' ') FROM passengers p WHERE p.booking_id = bk.id),
+           (SELECT group_concat(p.contact, ' ') FROM passengers p WHERE p.booking_id = bk.id)
+    FROM bookings bk JOIN users u ON u.id = bk.user_id {where}
+'''
+
+def _fts_refresh(booking_expr):
+    return (f"DELETE FROM bookings_fts WHERE rowid = {booking_expr};"
+            + _FTS_ROW_SELECT.format(where=f"WHERE bk.id = {booking_expr}") + ";")
+
+BOOKINGS_FTS_SCHEMA = f'''
+    CREATE VIRTUAL TABLE IF NOT EXISTS bookings_fts USING fts5(
+        pnr, user_name, user_email, passenger_names, passenger_contacts,
+        tokenize = 'unicode61'
+    );
+    CREATE TRIGGER IF NOT EXISTS bookings_fts_ai AFTER INSERT ON bookings BEGIN {_fts_refresh("NEW.id")} END;
+    CREATE TRIGGER IF NOT EXISTS bookings_fts_au AFTER UPDATE OF user_id ON bookings BEGIN {_fts_refresh("NEW.id")} END;
+    CREATE TRIGGER IF NOT EXISTS bookings_fts_ad AFTER DELETE ON bookings BEGIN
+        DELETE FROM bookings_fts WHERE rowid = OLD.id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS passengers_fts_ai AFTER INSERT ON passengers BEGIN {_fts_refresh("NEW.booking_id")} END;
+    CREATE TRIGGER IF NOT EXISTS passengers_fts_au AFTER UPDATE ON passengers BEGIN {_fts_refresh("NEW.booking_id")} END;
+    CREATE TRIGGER IF NOT EXISTS passengers_fts_ad AFTER DELETE ON passengers BEGIN {_fts_refresh("OLD.booking_id")} END;
+    CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE OF name, email ON users BEGIN
+        DELETE FROM bookings_fts WHERE rowid IN (SELECT id FROM bookings WHERE user_id = NEW.id);
+        {_FTS_ROW_SELECT.format(where="WHERE bk.user_id = NEW.id")};
+    END;
+'''
+
+BOOKING_SEARCH_LIMIT = 50
+PNR_PATTERN = re.compile(r'^(?:AB-?)?(\d+)$', re.IGNORECASE) # "AB-51", "ab51" or a bare "51"
+
+def build_fts_query(q):
+    """Turn free text into an FTS5 query: every term must match, last token as a prefix."""
+    terms = [f'"{term.replace(chr(34), chr(34) * 2)}"' for term in q.split()]
+    if terms:
+        terms[-1] += '*' # Still being typed
+    return ' '.join(terms)
+
+def pnr_booking_id(q):
+    # A query that is just a PNR or booking id is looked up by rowid ahead of the ranked matches
+    m = PNR_PATTERN.match(q.strip())
+    return int(m.group(1)) if m else None
+
+# --- Archival ---
+# Completed trips (travel_date in the past) move with their bookings and passengers
+# into one SQLite file per travel month, so the hot tables only hold the live horizon.
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+ARCHIVE_BATCH_SIZE = 500 # Schedules per transaction
+ARCHIVE_BATCH_PAUSE = 0.05 # Seconds between batches so live writers get the lock
+ARCHIVED_TABLES = ('schedules', 'bookings', 'passengers')
+
+def archive_files():
+    if not os.path.isdir(ARCHIVE_DIR):
+        return []
+    return sorted(os.path.join(ARCHIVE_DIR, f) for f in os.listdir(ARCHIVE_DIR)
+                  if f.startswith('autobus_') and f.endswith('.db'))
+
+def _table_columns(db, schema, table):
+    return [row[1] for row in db.execute(f"PRAGMA {schema}.table_info({table})").fetchall()]
+
+def _prepare_archive(db, schema):
+    # Mirror the live tables, picking up any columns added by later migrations
+    for table in ARCHIVED_TABLES:
+        db.execute(f"CREATE TABLE IF NOT EXISTS {schema}.{table} AS SELECT * FROM main.{table} WHERE 0")
+        archived = set(_table_columns(db, schema, table))
+        for row in db.execute(f"PRAGMA main.table_info({table})").fetchall():
+            if row[1] not in archived:
+                db.execute(f"ALTER TABLE {schema}.{table} ADD COLUMN {row[1]} {row[2]}")
+    db.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_schedules_id ON schedules (id)")
+    db.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_bookings_user ON bookings (user_id)")
+    db.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_bookings_schedule ON bookings (schedule_id)")
+    db.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_passengers_booking ON passengers (booking_id)")
+    db.commit()
+
+def archive_completed_trips(db, before=None, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move schedules with travel_date < before (default today) into monthly archive files."""
+    before = before or datetime.now().strftime('%Y-%m-%d')
+    db.commit()
+    cur = db.execute("SELECT DISTINCT substr(travel_date, 1, 7) FROM schedules WHERE travel_date < ? ORDER BY 1", (before,))
+    months = [row[0] for row in cur.fetchall()]
+    stats = {"before": before, "months": months, "schedules": 0, "bookings": 0, "passengers": 0}
+    if not months:
+        return stats
+
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    for month in months:
+        db.execute("ATTACH DATABASE ? AS arc", (os.path.join(ARCHIVE_DIR, f"autobus_{month.replace('-', '_')}.db"),))
+        try:
+            _prepare_archive(db, 'arc')
+            cols = {table: ', '.join(_table_columns(db, 'main', table)) for table in ARCHIVED_TABLES}
+            while True:
+                cur = db.execute('''
+                    SELECT id FROM schedules
+                    WHERE travel_date BETWEEN ? AND ? AND travel_date < ?
+                    LIMIT ?
+                ''', (f"{month}-01", f"{month}-31", before, batch_size))
+                ids = [row[0] for row in cur.fetchall()]
+                if not ids:
+                    break
+                ph = ','.join('?' * len(ids))
+                booking_ids = f"SELECT id FROM main.bookings WHERE schedule_id IN ({ph})"
+
+                # Copy then delete in one transaction, committed atomically across both files
+                db.execute("BEGIN IMMEDIATE")
+                db.execute(f"INSERT INTO arc.passengers ({cols['passengers']}) SELECT {cols['passengers']} FROM main.passengers WHERE booking_id IN ({booking_ids})", ids)
+                db.execute(f"INSERT INTO arc.bookings ({cols['bookings']}) SELECT {cols['bookings']} FROM main.bookings WHERE schedule_id IN ({ph})", ids)
+                db.execute(f"INSERT INTO arc.schedules ({cols['schedules']}) SELECT {cols['schedules']} FROM main.schedules WHERE id IN ({ph})", ids)
+                stats["passengers"] += db.execute(f"DELETE FROM main.passengers WHERE booking_id IN ({booking_ids})", ids).rowcount
+                stats["bookings"] += db.execute(f"DELETE FROM main.bookings WHERE schedule_id IN ({ph})", ids).rowcount
+                db.execute(f"DELETE FROM main.waitlist WHERE schedule_id IN ({ph})", ids)
+                stats["schedules"] += db.execute(f"DELETE FROM main.schedules WHERE id IN ({ph})", ids).rowcount
+                db.commit()
+                time.sleep(ARCHIVE_BATCH_PAUSE)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.execute("DETACH DATABASE arc")
+
+    db.execute("DELETE FROM fare_calendar WHERE travel_date < ?", (before,))
+    db.commit()
+    return stats
+
+def query_with_archives(db, query, params=(), history=False):
+    """Run query against the live tables and, when history is requested, every archive.
+
+    The query refers to archived tables as {schema}.bookings / {schema}.schedules /
+    {schema}.passengers; everything else (users, routes, ...) always comes from main.
+    """
+    rows = [dict(row) for row in db.execute(query.format(schema='main'), params).fetchall()]
+    if history:
+        for path in archive_files():
+            db.execute("ATTACH DATABASE ? AS arc", (path,))
+            try:
+                rows.extend(dict(row) for row in db.execute(query.format(schema='arc'), params).fetchall())
+            finally:
+                db.execute("DETACH DATABASE arc")
+    return rows
+
+def _wants_history():
+    return request.args.get('history', '').lower() in ('1', 'true', 'yes')
+
+# --- Backups ---
+# Snapshots are taken with VACUUM INTO, which copies the database from a single
+# read transaction. The database runs in WAL mode (see init_db), so that read
+# never blocks writers and writers never restart the copy. The work runs on a
+# background thread so POST /api/admin/backups returns straight away. A probe
+# times how long a writer waits for the write lock while the copy runs.
+import gzip
+import shutil
+
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", 7)) # Snapshots kept by rotation
+BACKUP_PROBE_INTERVAL = 0.01 # Seconds between writer-stall probes
+_backup_lock = threading.Lock() # One snapshot at a time
+_backup_job = {} # Status of the latest background backup, for GET /api/admin/backups
+
+def _sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _integrity_check(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("PRAGMA integrity_check").fetchone()[0]
+    finally:
+        conn.close()
+
+def _writer_stall_probe(stop, stalls):
+    # Take and immediately drop the write lock the way a booking would, timing the wait.
+    # BEGIN IMMEDIATE only takes the WAL write lock, so readers are never blocked.
+    conn = sqlite3.connect(DB_NAME, timeout=30, isolation_level=None)
+    try:
+        while not stop.is_set():
+            start = time.perf_counter()
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("ROLLBACK")
+            stalls.append(time.perf_counter() - start)
+            stop.wait(BACKUP_PROBE_INTERVAL)
+    finally:
+        conn.close()
+
+def list_backups():
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    return sorted((os.path.join(BACKUP_DIR, f) for f in os.listdir(BACKUP_DIR)
+                   if f.startswith('autobus_') and f.endswith('.db.gz')), reverse=True)
+
+def rotate_backups(keep=BACKUP_KEEP):
+    removed = []
+    for path in list_backups()[keep:]:
+        for p in (path, path + '.sha256'):
+            if os.path.exists(p):
+                os.remove(p)
+        removed.append(path)
+    return removed
+
+def backup_database(probe=True):
+    """Write a compressed, checksummed snapshot of DB_NAME into BACKUP_DIR."""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    name = f"autobus_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.db"
+    partial = os.path.join(BACKUP_DIR, name + '.partial')
+    final = os.path.join(BACKUP_DIR, name + '.gz')
+
+    stop, stalls = threading.Event(), []
+    prober = threading.Thread(target=_writer_stall_probe, args=(stop, stalls), daemon=True) if probe else None
+
+    start = time.perf_counter()
+    src = sqlite3.connect(DB_NAME, timeout=30, isolation_level=None)
+    try:
+        journal_mode = src.execute("PRAGMA journal_mode").fetchone()[0]
+        if prober:
+            prober.start()
+        # One read transaction from start to end: a consistent copy that writers can't restart
+        src.execute("VACUUM INTO ?", (partial,))
+    except sqlite3.Error:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    finally:
+        stop.set()
+        if prober:
+            prober.join()
+        src.close()
+    backup_seconds = time.perf_counter() - start
+
+    check = _integrity_check(partial)
+    if check != 'ok':
+        os.remove(partial)
+        raise RuntimeError(f"Backup failed integrity check: {check}")
+
+    # Compress under a temporary name so list_backups never shows a half-written snapshot
+    with open(partial, 'rb') as f_in, gzip.open(final + '.partial', 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(partial)
+    os.replace(final + '.partial', final)
+    checksum = _sha256_file(final)
+    with open(final + '.sha256', 'w') as f:
+        f.write(f"{checksum}  {os.path.basename(final)}\n")
+
+    return {
+        "path": final,
+        "sha256": checksum,
+        "bytes": os.path.getsize(final),
+        "journal_mode": journal_mode,
+        "seconds": round(time.perf_counter() - start, 3),
+        "backup_seconds": round(backup_seconds, 3),
+        "max_writer_stall_ms": round(max(stalls) * 1000, 3) if stalls else None,
+        "writer_probes": len(stalls),
+        "rotated": rotate_backups(),
+    }
+
+def _run_backup_job():
+    try:
+        stats = backup_database()
+        _backup_job.update(status='done', finished_at=datetime.now().isoformat(timespec='seconds'), result=stats)
+        print(f"Backup {stats['path']} in {stats['seconds']}s, max writer stall {stats['max_writer_stall_ms']}ms")
+    except (sqlite3.Error, OSError, RuntimeError) as e:
+        _backup_job.update(status='failed', finished_at=datetime.now().isoformat(timespec='seconds'), error=str(e))
+        print(f"Backup failed: {e}")
+    finally:
+        _backup_lock.release()
+
+def start_backup_job():
+    """Kick off backup_database() on a background thread. Returns False if one is already running."""
+    if not _backup_lock.acquire(blocking=False):
+        return False
+    _backup_job.clear()
+    _backup_job.update(status='running', started_at=datetime.now().isoformat(timespec='seconds'))
+    threading.Thread(target=_run_backup_job, name='backup', daemon=True).start()
+    return True
+
+def restore_database(snapshot, target=None):
+    """Verify a snapshot (checksum + integrity_check) and copy it over target (default DB_NAME)."""
+    target = target or DB_NAME
+    sidecar = snapshot + '.sha256'
+    if os.path.exists(sidecar):
+        with open(sidecar) as f:
+            expected = f.read().split()[0]
+        if _sha256_file(snapshot) != expected:
+            raise RuntimeError("Snapshot checksum mismatch")
+
+    fd, tmp_path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        with gzip.open(snapshot, 'rb') as f_in, open(tmp_path, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        check = _integrity_check(tmp_path)
+        if check != 'ok':
+            raise RuntimeError(f"Snapshot failed integrity check: {check}")
+
+        # Restore through the backup API as well, so open connections see a consistent swap
+        src, dst = sqlite3.connect(tmp_path), sqlite3.connect(target, timeout=30)
+        try:
+            src.backup(dst)
+        finally:
+            src.close()
+            dst.close()
+    finally:
+        os.remove(tmp_path)
+
+    check = _integrity_check(target)
+    if check != 'ok':
+        raise RuntimeError(f"Restored database failed integrity check: {check}")
+    return {"restored": target, "from": snapshot, "integrity": check}
+
 # --- Seeding Data ---
 def seed_data():
     with app.app_context():
@@ -221,6 +700,7 @@ def seed_data():
         existing_dates = {row[0] for row in cur.fetchall()}
         
         print("Checking schedules for next 30 days...")
+        new_dates = []
         for day_offset in range(30):
             current_date = (today + timedelta(days=day_offset)).strftime("%Y-%m-%d")
             
@@ -228,6 +708,7 @@ def seed_data():
                 continue # Skip if already exists
                 
             print(f"Generating schedules for {current_date}...")
+            new_dates.append(current_date)
             
             for r_idx, route_id in enumerate(route_ids):
                 # 10% Chance of NO BUSES (Off Day) - Reduced from 20%
@@ -248,6 +729,9 @@ def seed_data():
                         INSERT INTO schedules (bus_id, route_id, departure_time, arrival_time, travel_date, price) 
                         VALUES (?, ?, ?, ?, ?, ?)
                     ''', (bus_id, route_id, dep_time, arr_time, current_date, price))
+
+        for current_date in new_dates:
+            refresh_fare_calendar(db, travel_date=current_date)
         
         db.commit()
 
@@ -340,24 +824,138 @@ load_dotenv()
 import qrcode
 import tempfile
 
+# --- Signed Ticket QR ---
+# QR codes carry a compact binary payload (booking, schedule, seat bitmap, expiry)
+# signed with HMAC-SHA256 so conductors can verify tickets without trusting free text.
+import hmac
+import base64
+import struct
+from collections import deque
+
+QR_SIGNING_KEY = (os.getenv("QR_SIGNING_KEY") or app.secret_key).encode()
+QR_PREFIX = "AB1" # Also the payload version
+QR_STRUCT = struct.Struct(">IIIQ") # booking id, schedule id, expiry (unix seconds), seat bitmap
+QR_SIG_BYTES = 10 # Truncated HMAC
+QR_VALID_AFTER_DEPARTURE = timedelta(hours=24)
+SEAT_COLUMNS = 'ABCD' # Matches the 4-across seat map in seats.html
+
+def _seat_bit(seat):
+    row, col = int(seat[:-1]), SEAT_COLUMNS.index(seat[-1].upper())
+    bit = (row - 1) * len(SEAT_COLUMNS) + col
+    if row < 1 or bit >= 64:
+        raise ValueError(f"Seat {seat} does not fit the QR seat bitmap")
+    return bit
+
+def encode_seat_bitmap(seats):
+    bitmap = 0
+    for seat in seats:
+        bitmap |= 1 << _seat_bit(seat)
+    return bitmap
+
+def decode_seat_bitmap(bitmap):
+    return [f"{bit // len(SEAT_COLUMNS) + 1}{SEAT_COLUMNS[bit % len(SEAT_COLUMNS)]}"
+            for bit in range(64) if bitmap >> bit & 1]
+
+def sign_ticket_payload(booking_id, schedule_id, seats, travel_date, departure_time):
+    departure = datetime.strptime(f"{travel_date} {departure_time}", "%Y-%m-%d %H:%M")
+    expiry = int((departure + QR_VALID_AFTER_DEPARTURE).timestamp())
+    body = QR_STRUCT.pack(booking_id, schedule_id, expiry, encode_seat_bitmap(seats))
+    sig = hmac.new(QR_SIGNING_KEY, body, hashlib.sha256).digest()[:QR_SIG_BYTES]
+    # Base32 stays inside the QR alphanumeric charset, which encodes denser than bytes
+    return QR_PREFIX + base64.b32encode(body + sig).decode().rstrip('=')
+
+def decode_ticket_payload(code):
+    """Returns the signed ticket fields, or raises ValueError with a short reason."""
+    if not isinstance(code, str) or not code.startswith(QR_PREFIX):
+        raise ValueError("malformed")
+    raw = code[len(QR_PREFIX):]
+    try:
+        blob = base64.b32decode(raw + '=' * (-len(raw) % 8))
+    except (ValueError, TypeError):
+        raise ValueError("malformed")
+    if len(blob) != QR_STRUCT.size + QR_SIG_BYTES:
+        raise ValueError("malformed")
+
+    body, sig = blob[:QR_STRUCT.size], blob[QR_STRUCT.size:]
+    expected = hmac.new(QR_SIGNING_KEY, body, hashlib.sha256).digest()[:QR_SIG_BYTES]
+    if not hmac.compare_digest(sig, expected):
+        raise ValueError("bad_signature")
+
+    booking_id, schedule_id, expiry, bitmap = QR_STRUCT.unpack(body)
+    return {"bookingId": booking_id, "scheduleId": schedule_id, "expiry": expiry,
+            "seats": decode_seat_bitmap(bitmap)}
+
+# Per-schedule set of confirmed booking ids used by /api/verify-ticket.
+# Bookings and cancellations update it in place, the TTL bounds staleness
+# from writes made by other processes.
+VALID_BOOKINGS_TTL = 60
+_valid_bookings = {} # schedule_id -> (loaded_at, set of booking ids)
+_valid_bookings_gen = {} # schedule_id -> generation, bumped on every change
+_valid_bookings_lock = threading.Lock()
+
+def valid_bookings_for(db, schedule_id):
+    now = time.monotonic()
+    with _valid_bookings_lock:
+        entry = _valid_bookings.get(schedule_id)
+        if entry and now - entry[0] < VALID_BOOKINGS_TTL:
+            return entry[1]
+        gen = _valid_bookings_gen.get(schedule_id, 0)
+
+    cur = db.execute("SELECT id FROM bookings WHERE schedule_id = ? AND status = 'confirmed'", (schedule_id,))
+    ids = {row[0] for row in cur.fetchall()}
+
+    with _valid_bookings_lock:
+        # Don't cache a set that a concurrent booking or cancellation has already made stale
+        if _valid_bookings_gen.get(schedule_id, 0) == gen:
+            _valid_bookings[schedule_id] = (now, ids)
+    return ids
+
+def mark_booking_valid(schedule_id, booking_id):
+    with _valid_bookings_lock:
+        _valid_bookings_gen[schedule_id] = _valid_bookings_gen.get(schedule_id, 0) + 1
+        entry = _valid_bookings.get(schedule_id)
+        if entry:
+            entry[1].add(booking_id)
+
+def mark_booking_invalid(schedule_id, booking_id):
+    with _valid_bookings_lock:
+        _valid_bookings_gen[schedule_id] = _valid_bookings_gen.get(schedule_id, 0) + 1
+        entry = _valid_bookings.get(schedule_id)
+        if entry:
+            entry[1].discard(booking_id)
+
 def generate_ticket_pdf(booking_data):
     pdf = FPDF()
+    _render_ticket_page(pdf, booking_data)
+    return pdf.output(dest='S').encode('latin-1') # Return bytes
+
+def generate_group_ticket_pdf(bookings_data):
+    # One consolidated document, one page per booking
+    pdf = FPDF()
+    for booking_data in bookings_data:
+        _render_ticket_page(pdf, booking_data)
+    return pdf.output(dest='S').encode('latin-1')
+
+def _render_pdf_header(pdf, title, subtitle):
     pdf.add_page()
     pdf.set_font("Arial", size=12)
     
     # Header
     pdf.set_font("Arial", 'B', 20)
     pdf.set_text_color(209, 46, 46) # Primary Red
-    pdf.cell(200, 10, txt="AutoBusBook Ticket", ln=1, align='C')
+    pdf.cell(200, 10, txt=title, ln=1, align='C')
     pdf.ln(5)
     
     # Booking Checkmark Style
     pdf.set_font("Arial", 'B', 14)
     pdf.set_text_color(0, 128, 0) # Green
-    pdf.cell(200, 10, txt="Booking Confirmed", ln=1, align='C')
+    pdf.cell(200, 10, txt=subtitle, ln=1, align='C')
     pdf.ln(5)
     
     pdf.set_text_color(0, 0, 0) # Reset
+
+def _render_ticket_page(pdf, booking_data):
+    _render_pdf_header(pdf, "AutoBusBook Ticket", "Booking Confirmed")
     
     # Details Box
     pdf.set_fill_color(245, 245, 245)
@@ -384,14 +982,12 @@ def generate_ticket_pdf(booking_data):
     pdf.cell(0, 10, txt="Passengers:", ln=1)
     
     pdf.set_font("Arial", '', 11)
-    passengers = booking_data['passengers']
-    if isinstance(passengers, str):
-        passengers = json.loads(passengers)
+    passengers = booking_data['passengers'] or []
         
     y = 100
     for p in passengers:
         pdf.set_xy(20, y)
-        contact = p.get('phone') or p.get('email', '')
+        contact = p.get('contact') or ''
         pdf.cell(0, 8, txt=f"- {p['name']} ({p['gender']}, {p['age']}y) | Seat: {p['seat']} | {contact}", ln=1)
         y += 8
         
@@ -402,10 +998,11 @@ def generate_ticket_pdf(booking_data):
     
     # --- Backend QR Code Generation ---
     try:
-        qr_data = f"PNR: AB-{booking_data['id']}\nRoute: {booking_data['from_city']} to {booking_data['to_city']}\nDate: {booking_data['travel_date']}\n\nPassengers:\n"
-        for p in passengers:
-            contact = p.get('phone') or p.get('email', '')
-            qr_data += f"- {p['name']} ({p.get('age','')}y) | Seat: {p['seat']} | {contact}\n"
+        seats = booking_data['seats']
+        if isinstance(seats, str):
+            seats = json.loads(seats)
+        qr_data = sign_ticket_payload(booking_data['id'], booking_data['schedule_id'], seats,
+                                      booking_data['travel_date'], booking_data['departure_time'])
             
         qr = qrcode.make(qr_data)
         
@@ -435,8 +1032,160 @@ def generate_ticket_pdf(booking_data):
     pdf.ln(50) # Spacer for QR
     pdf.set_font("Arial", 'I', 10)
     pdf.cell(0, 10, txt="Thank you for choosing AutoBusBook!", ln=1, align='C')
-    
-    return pdf.output(dest='S').encode('latin-1') # Return bytes
+
+# --- Boarding Manifests ---
+import csv
+import zipfile
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+# By the time manifests render, the process runs mail/flash-sale/backup threads, and
+# forking it can deadlock on their locks. Render processes come from a forkserver instead.
+_manifest_mp_context = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+MANIFEST_COLUMNS = ['seat', 'name', 'age', 'gender', 'contact', 'booking_id']
+
+def _seat_sort_key(seat):
+    # '2B' -> (2, 'B') so row 10 sorts after row 9
+    digits = ''.join(ch for ch in seat if ch.isdigit())
+    return (int(digits) if digits else 0, seat)
+
+def load_day_manifests(db, travel_date, operator=None):
+    """Every departure on travel_date with its confirmed passengers, in one query."""
+    query = '''
+        SELECT s.id as schedule_id, s.travel_date, s.departure_time, s.arrival_time,
+               r.from_city, r.to_city, b.bus_number, b.bus_type, bo.name as operator,
+               bk.id as booking_id, bk.seats,
+               p.seat, p.name, p.age, p.gender, p.contact
+        FROM schedules s
+        JOIN routes r ON s.route_id = r.id
+        JOIN buses b ON s.bus_id = b.id
+        JOIN bus_operators bo ON b.operator_id = bo.id
+        LEFT JOIN bookings bk ON bk.schedule_id = s.id AND bk.status = 'confirmed'
+        LEFT JOIN passengers p ON p.booking_id = bk.id
+        WHERE s.travel_date = ? AND s.status != 'CANCELLED'
+    '''
+    params = [travel_date]
+    if operator:
+        query += " AND bo.name = ?"
+        params.append(operator)
+    query += " ORDER BY bo.name, s.departure_time, s.id, bk.id, p.id"
+
+    manifests = {}
+    seen_bookings = set()
+    for row in db.execute(query, params).fetchall():
+        m = manifests.get(row['schedule_id'])
+        if m is None:
+            m = manifests[row['schedule_id']] = {
+                key: row[key] for key in ('schedule_id', 'travel_date', 'departure_time', 'arrival_time',
+                                          'from_city', 'to_city', 'bus_number', 'bus_type', 'operator')
+            }
+            m['passengers'] = []
+        if row['booking_id'] is None:
+            continue
+        if row['seat'] is not None:
+            m['passengers'].append({key: row[key] for key in MANIFEST_COLUMNS})
+        elif row['booking_id'] not in seen_bookings:
+            # Booking without passenger details, still list its seats
+            for seat in json.loads(row['seats']):
+                m['passengers'].append({'seat': seat, 'name': '-', 'age': None, 'gender': None,
+                                        'contact': None, 'booking_id': row['booking_id']})
+        seen_bookings.add(row['booking_id'])
+
+    for m in manifests.values():
+        m['passengers'].sort(key=lambda p: _seat_sort_key(p['seat']))
+    return list(manifests.values())
+
+def _latin1(value):
+    # FPDF 1.7 core fonts are Latin-1 only: strip accents ('Ł' stays '?'), replace the rest.
+    # The CSV keeps the original UTF-8 names.
+    text = '' if value is None else str(value)
+    text = ''.join(ch for ch in unicodedata.normalize('NFKD', text) if not unicodedata.combining(ch))
+    return text.encode('latin-1', 'replace').decode('latin-1')
+
+def render_manifest_pdf(manifest):
+    manifest = {k: v if k == 'passengers' else _latin1(v) for k, v in manifest.items()}
+    pdf = FPDF()
+    _render_pdf_header(pdf, "AutoBusBook Boarding Manifest", f"{manifest['operator']} - {manifest['bus_number']}")
+
+    pdf.set_font("Arial", '', 12)
+    pdf.cell(0, 8, txt=f"Route: {manifest['from_city']} to {manifest['to_city']}", ln=1)
+    pdf.cell(0, 8, txt=f"Date: {manifest['travel_date']} | Departure: {manifest['departure_time']} | Arrival: {manifest['arrival_time']}", ln=1)
+    pdf.cell(0, 8, txt=f"Bus: {manifest['bus_type']} | Passengers: {len(manifest['passengers'])}", ln=1)
+    pdf.ln(4)
+
+    widths = [18, 62, 14, 22, 46, 28]
+    pdf.set_font("Arial", 'B', 11)
+    pdf.set_fill_color(245, 245, 245)
+    for width, title in zip(widths, ['Seat', 'Name', 'Age', 'Gender', 'Contact', 'PNR']):
+        pdf.cell(width, 8, txt=title, border=1, fill=True)
+    pdf.ln()
+
+    pdf.set_font("Arial", '', 10)
+    for p in manifest['passengers']:
+        values = [p['seat'], p['name'], p['age'], p['gender'], p['contact'], f"AB-{p['booking_id']}"]
+        for width, value in zip(widths, values):
+            pdf.cell(width, 7, txt=_latin1(value), border=1)
+        pdf.ln()
+
+    return pdf.output(dest='S').encode('latin-1')
+
+def render_manifest_csv(manifest):
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=MANIFEST_COLUMNS)
+    writer.writeheader()
+    writer.writerows(manifest['passengers'])
+    return out.getvalue().encode('utf-8')
+
+def _render_manifest_files(manifest):
+    # Runs inside pool workers, so it must stay a picklable module-level function
+    base = (f"{manifest['operator']}/{manifest['travel_date']}_{manifest['departure_time'].replace(':', '')}"
+            f"_{manifest['from_city']}-{manifest['to_city']}_{manifest['schedule_id']}").replace(' ', '_')
+    files = [(f"{base}.csv", render_manifest_csv(manifest))]
+    try:
+        files.insert(0, (f"{base}.pdf", render_manifest_pdf(manifest)))
+    except Exception as e:
+        # One bad manifest must not sink the whole day's zip; the CSV still goes out
+        print(f"Manifest PDF failed for schedule {manifest['schedule_id']}: {e}")
+    return files
+
+def generate_day_manifests(db, travel_date, operator=None, workers=None):
+    """Render every manifest for a day into a zip archive. Returns (zip_bytes, stats)."""
+    manifests = load_day_manifests(db, travel_date, operator)
+
+    start = time.perf_counter()
+    if workers == 1 or len(manifests) <= 1:
+        rendered = [_render_manifest_files(m) for m in manifests]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=_manifest_mp_context) as pool:
+            rendered = list(pool.map(_render_manifest_files, manifests, chunksize=4))
+
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for files in rendered:
+            for name, content in files:
+                zf.writestr(name, content)
+    elapsed = time.perf_counter() - start
+
+    stats = {
+        "date": travel_date,
+        "manifests": len(manifests),
+        "passengers": sum(len(m['passengers']) for m in manifests),
+        "seconds": round(elapsed, 3),
+        "manifests_per_sec": round(len(manifests) / elapsed, 2) if elapsed > 0 else None,
+        "failed_pdfs": sum(1 for files in rendered if not files[0][0].endswith('.pdf')),
+    }
+    return buf.getvalue(), stats
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Background mail sender so notifications never hold up a request
+_mail_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='mail')
+
+def queue_email(to_email, subject, body, attachment=None):
+    return _mail_pool.submit(send_email, to_email, subject, body, attachment)
 
 def send_email(to_email, subject, body, attachment=None):
     sender_email = os.getenv("SMTP_EMAIL")
@@ -622,7 +1371,7 @@ def api_search():
         JOIN buses b ON s.bus_id = b.id
         JOIN bus_operators bo ON b.operator_id = bo.id
         JOIN routes r ON s.route_id = r.id
-        WHERE r.from_city LIKE ? AND r.to_city LIKE ? AND s.travel_date = ?
+        WHERE r.from_city LIKE ? AND r.to_city LIKE ? AND s.travel_date = ? AND s.status != 'CANCELLED'
     '''
     
     db = get_db()
@@ -632,6 +1381,27 @@ def api_search():
     
     return jsonify(results)
 
+@app.route('/api/fare-calendar')
+def api_fare_calendar():
+    from_city = request.args.get('from')
+    to_city = request.args.get('to')
+    if not from_city or not to_city:
+        return jsonify({"error": "from and to are required"}), 400
+
+    query = '''
+        SELECT fc.travel_date, MIN(fc.min_price) as min_price,
+               SUM(fc.departures) as departures, SUM(fc.seats_left) as seats_left
+        FROM routes r
+        JOIN fare_calendar fc ON fc.route_id = r.id
+        WHERE r.from_city LIKE ? AND r.to_city LIKE ? AND fc.travel_date >= ?
+        GROUP BY fc.travel_date
+        ORDER BY fc.travel_date
+    '''
+    db = get_db()
+    # Same flexible matching as /api/search
+    cur = db.execute(query, (f'%{from_city}%', f'%{to_city}%', datetime.now().strftime('%Y-%m-%d')))
+    return jsonify([dict(row) for row in cur.fetchall()])
+
 @app.route('/api/schedule/<int:id>')
 def api_schedule_details(id):
     query = '''
@@ -675,12 +1445,104 @@ def api_cities():
     cities.sort()
     return jsonify(cities)
 
+# --- Idempotency Keys ---
+# Retried POST /api/book calls carrying the same Idempotency-Key header get the
+# original response replayed instead of creating a second booking/PDF/email.
+IDEMPOTENCY_TTL_HOURS = 24
+IDEMPOTENCY_WAIT_SECONDS = 30 # How long a duplicate waits for the in-flight original
+IDEMPOTENCY_LEASE_SECONDS = 300 # In-flight claims older than this were abandoned (e.g. the process died)
+IDEMPOTENCY_CLEANUP_INTERVAL = 60 # Seconds between TTL sweeps
+_last_idempotency_cleanup = 0.0
+
+def cleanup_idempotency_keys(db):
+    cutoff = (datetime.now() - timedelta(hours=IDEMPOTENCY_TTL_HOURS)).strftime('%Y-%m-%d %H:%M:%S')
+    cur = db.execute("DELETE FROM idempotency_keys WHERE created_at < ?", (cutoff,))
+    db.commit()
+    return cur.rowcount
+
+def _maybe_cleanup_idempotency_keys(db):
+    global _last_idempotency_cleanup
+    now = time.monotonic()
+    if now - _last_idempotency_cleanup >= IDEMPOTENCY_CLEANUP_INTERVAL:
+        _last_idempotency_cleanup = now
+        cleanup_idempotency_keys(db)
+
+def _idempotent(user_id, idem_key, handler):
+    """Run handler() at most once per (user, key) and replay its response."""
+    db = get_db()
+    _maybe_cleanup_idempotency_keys(db)
+    request_hash = hashlib.sha256(request.get_data()).hexdigest()
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+
+    while True:
+        # Claim the key. The primary key makes this atomic across threads and processes.
+        # created_at doubles as the claim timestamp for the lease below.
+        claimed_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        cur = db.execute('''
+            INSERT OR IGNORE INTO idempotency_keys (user_id, idem_key, request_hash, created_at)
+            VALUES (?, ?, ?, ?)
+        ''', (user_id, idem_key, request_hash, claimed_at))
+        db.commit()
+        if cur.rowcount == 1:
+            break
+
+        # Release a claim whose owner never finished so this retry can take it over
+        lease_cutoff = (datetime.now() - timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS)).strftime('%Y-%m-%d %H:%M:%S')
+        cur = db.execute('''
+            DELETE FROM idempotency_keys
+            WHERE user_id = ? AND idem_key = ? AND status_code IS NULL AND created_at < ?
+        ''', (user_id, idem_key, lease_cutoff))
+        db.commit()
+        if cur.rowcount == 1:
+            continue
+
+        cur = db.execute("SELECT request_hash, status_code, response_body FROM idempotency_keys WHERE user_id = ? AND idem_key = ?",
+                         (user_id, idem_key))
+        row = cur.fetchone()
+        if row is None:
+            continue # Original attempt failed and released the key, try to claim it again
+        if row['request_hash'] != request_hash:
+            return jsonify({"error": "Idempotency-Key was already used with a different request body"}), 422
+        if row['status_code'] is not None:
+            resp = Response(row['response_body'], status=row['status_code'], mimetype='application/json')
+            resp.headers['Idempotent-Replayed'] = 'true'
+            return resp
+        if time.monotonic() >= deadline:
+            return jsonify({"error": "A request with this Idempotency-Key is still being processed"}), 409
+        time.sleep(0.05)
+
+    # Only touch the row while we still own the claim (it may have expired and been re-claimed)
+    owned = "user_id = ? AND idem_key = ? AND created_at = ? AND status_code IS NULL"
+    try:
+        resp = make_response(handler())
+    except Exception:
+        db.execute(f"DELETE FROM idempotency_keys WHERE {owned}", (user_id, idem_key, claimed_at))
+        db.commit()
+        raise
+
+    if resp.status_code >= 500:
+        # Server errors are not final, let the client retry with the same key
+        db.execute(f"DELETE FROM idempotency_keys WHERE {owned}", (user_id, idem_key, claimed_at))
+    else:
+        db.execute(f"UPDATE idempotency_keys SET status_code = ?, response_body = ? WHERE {owned}",
+                   (resp.status_code, resp.get_data(as_text=True), user_id, idem_key, claimed_at))
+    db.commit()
+    return resp
+
 @app.route('/api/book', methods=['POST'])
 def api_book():
     if 'user_id' not in session:
         return jsonify({"error": "Unauthorized. Please login."}), 401
 
-    data = request.json
+    idem_key = request.headers.get('Idempotency-Key')
+    if not idem_key:
+        return _create_booking(request.json)
+    if len(idem_key) > 255:
+        return jsonify({"error": "Idempotency-Key too long"}), 400
+
+    return _idempotent(session['user_id'], idem_key, lambda: _create_booking(request.json))
+
+def _create_booking(data):
     try:
         schedule_id = data.get('scheduleId')
         seat_numbers = data.get('seats') # List of strings e.g. ['2A', '2B']
@@ -690,16 +1552,25 @@ def api_book():
 
         # Calculate Amount
         db = get_db()
-        cur = db.execute("SELECT price FROM schedules WHERE id = ?", (schedule_id,))
+        cur = db.execute("SELECT price, route_id, travel_date, status FROM schedules WHERE id = ?", (schedule_id,))
         sch = cur.fetchone()
         if not sch:
             return jsonify({"error": "Schedule not found"}), 404
+        if sch['status'] == 'CANCELLED':
+            return jsonify({"error": "This departure has been cancelled"}), 409
         
         total = sch['price'] * len(seat_numbers)
         
         # Verify passenger count matches seats
         if passengers and len(passengers) != len(seat_numbers):
              return jsonify({"error": "Passenger details missing for some seats"}), 400
+        if passengers and not all(p.get('name') and p.get('seat') for p in passengers):
+             return jsonify({"error": "Each passenger needs a name and seat"}), 400
+
+        # Hot departures in flash-sale mode are booked by their dedicated worker
+        worker = flash_sale_worker(schedule_id)
+        if worker:
+            return _flash_sale_book(worker, user_id, seat_numbers, passengers)
 
         # --- CRITICAL: Check for Double Booking ---
         # Get all currently booked seats for this schedule
@@ -716,69 +1587,414 @@ def api_book():
         # ------------------------------------------
 
         cur = db.execute('''
-            INSERT INTO bookings (user_id, schedule_id, seats, passengers, total_amount, status)
-            VALUES (?, ?, ?, ?, ?, 'confirmed')
-        ''', (user_id, schedule_id, json.dumps(seat_numbers), json.dumps(passengers) if passengers else None, total))
-        db.commit()
-        
+            INSERT INTO bookings (user_id, schedule_id, seats, total_amount, status)
+            VALUES (?, ?, ?, ?, 'confirmed')
+        ''', (user_id, schedule_id, json.dumps(seat_numbers), total))
         booking_id = cur.lastrowid
+        db.executemany(INSERT_PASSENGER_SQL, passenger_rows(booking_id, passengers))
+        refresh_fare_calendar(db, sch['route_id'], sch['travel_date'])
+        db.commit()
+        mark_booking_valid(schedule_id, booking_id)
         
-        # --- Send Ticket Email ---
-        try:
-            # Re-fetch full details for PDF
-            query = '''
-                SELECT bk.id, bk.total_amount, bk.passengers, bk.seats,
-                       s.departure_time, s.travel_date,
-                       r.from_city, r.to_city, bo.name as operator
-                FROM bookings bk
-                JOIN schedules s ON bk.schedule_id = s.id
-                JOIN routes r ON s.route_id = r.id
-                JOIN buses b ON s.bus_id = b.id
-                JOIN bus_operators bo ON b.operator_id = bo.id
-                WHERE bk.id = ?
-            '''
-            cur = db.execute(query, (booking_id,))
-            booking_data = dict(cur.fetchone())
-            
-            pdf_bytes = generate_ticket_pdf(booking_data)
-            
-            user_email = session.get('user_email')
-            if user_email:
-                subject = f"Your Ticket - {booking_data['from_city']} to {booking_data['to_city']}"
-                body = "Please find attached your ticket."
-                send_email(user_email, subject, body, attachment=(f"ticket_{booking_id}.pdf", pdf_bytes))
-        except Exception as ex:
-            print(f"Email failed: {ex}")
-            
+        _send_ticket_email(db, booking_id)
         return jsonify({"message": "Booking successful", "ticketId": booking_id})
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def _send_ticket_email(db, booking_id):
+    try:
+        # Re-fetch full details for PDF
+        query = '''
+            SELECT bk.id, bk.schedule_id, bk.total_amount, bk.seats,
+                   s.departure_time, s.travel_date,
+                   r.from_city, r.to_city, bo.name as operator
+            FROM bookings bk
+            JOIN schedules s ON bk.schedule_id = s.id
+            JOIN routes r ON s.route_id = r.id
+            JOIN buses b ON s.bus_id = b.id
+            JOIN bus_operators bo ON b.operator_id = bo.id
+            WHERE bk.id = ?
+        '''
+        cur = db.execute(query, (booking_id,))
+        booking_data = dict(cur.fetchone())
+        booking_data['passengers'] = fetch_passengers(db, [booking_id])[booking_id]
+        
+        pdf_bytes = generate_ticket_pdf(booking_data)
+        
+        user_email = session.get('user_email')
+        if user_email:
+            subject = f"Your Ticket - {booking_data['from_city']} to {booking_data['to_city']}"
+            body = "Please find attached your ticket."
+            send_email(user_email, subject, body, attachment=(f"ticket_{booking_id}.pdf", pdf_bytes))
+    except Exception as ex:
+        print(f"Email failed: {ex}")
+
+# --- Flash Sale Booking ---
+# Opt-in per schedule. Every booking request for a flash-sale schedule is queued to
+# one worker thread that owns that schedule's seats. The worker takes the write
+# lock once per batch, re-reads booked seats, accepts/rejects the whole batch in
+# memory and commits it together, replying to each request through a Future.
+import queue
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+FLASH_SALE_SCHEDULES = {int(x) for x in os.getenv("FLASH_SALE_SCHEDULES", "").split(",") if x.strip()}
+FLASH_SALE_QUEUE_LIMIT = 200 # Queued requests per schedule before shedding load
+FLASH_SALE_BATCH_SIZE = 50
+FLASH_SALE_BATCH_WINDOW = 0.005 # Seconds to wait for more requests to join a batch
+FLASH_SALE_WAIT = 10 # Seconds a request waits for its batch
+FLASH_SALE_RETRY_AFTER = 2
+
+_flash_sale_workers = {}
+_flash_sale_lock = threading.Lock()
+
+class ScheduleBookingWorker(threading.Thread):
+    def __init__(self, schedule_id):
+        super().__init__(daemon=True, name=f"flash-sale-{schedule_id}")
+        self.schedule_id = schedule_id
+        self.requests = queue.Queue(maxsize=FLASH_SALE_QUEUE_LIMIT)
+        self.booked = set() # Seats as of the last commit, used for admission checks
+        # Bumped by flash_sale_seats_released() after a cancellation commits. While booked
+        # was read before the latest release it may hold freed seats, so admission skips it.
+        self.releases = 0
+        self.booked_as_of = 0
+        self.running = True
+
+    def submit(self, user_id, seat_numbers, passengers):
+        # Raises queue.Full when the schedule is overloaded
+        future = Future()
+        self.requests.put_nowait((user_id, seat_numbers, passengers, future))
+        return future
+
+    def stop(self):
+        self.running = False
+        try:
+            self.requests.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def run(self):
+        db = sqlite3.connect(DB_NAME, timeout=30)
+        db.row_factory = sqlite3.Row
+        try:
+            as_of = self.releases
+            self.booked = booked_seats_for(db, self.schedule_id)
+            self.booked_as_of = as_of
+            while self.running:
+                batch = self._next_batch()
+                if batch:
+                    self._commit_batch(db, batch)
+        finally:
+            db.close()
+            # Fail whatever is still queued so no request waits forever
+            while True:
+                try:
+                    item = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if item and item[3].set_running_or_notify_cancel():
+                    item[3].set_exception(RuntimeError("Flash sale ended for this departure, please retry"))
+
+    def _next_batch(self):
+        item = self.requests.get()
+        batch = []
+        deadline = time.monotonic() + FLASH_SALE_BATCH_WINDOW
+        while item is not None:
+            # Requests that already timed out and were cancelled are dropped here
+            if item[3].set_running_or_notify_cancel():
+                batch.append(item)
+            if len(batch) >= FLASH_SALE_BATCH_SIZE:
+                break
+            try:
+                item = self.requests.get(timeout=max(deadline - time.monotonic(), 0.0001))
+            except queue.Empty:
+                break
+        return batch
+
+    def _commit_batch(self, db, batch):
+        results = []
+        as_of = self.releases
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            cur = db.execute("SELECT price, route_id, travel_date, status FROM schedules WHERE id = ?", (self.schedule_id,))
+            sch = cur.fetchone()
+            # Re-read under the lock so cancellations and other writers are always seen
+            booked = booked_seats_for(db, self.schedule_id)
+            for user_id, seat_numbers, passengers, future in batch:
+                if sch['status'] == 'CANCELLED':
+                    results.append((future, ('cancelled', None)))
+                    continue
+                taken = next((seat for seat in seat_numbers if seat in booked), None)
+                if taken:
+                    results.append((future, ('conflict', taken)))
+                    continue
+                booked.update(seat_numbers)
+                cur = db.execute('''
+                    INSERT INTO bookings (user_id, schedule_id, seats, total_amount, status)
+                    VALUES (?, ?, ?, ?, 'confirmed')
+                ''', (user_id, self.schedule_id, json.dumps(seat_numbers), sch['price'] * len(seat_numbers)))
+                db.executemany(INSERT_PASSENGER_SQL, passenger_rows(cur.lastrowid, passengers))
+                results.append((future, ('booked', cur.lastrowid)))
+            if any(outcome == 'booked' for _, (outcome, _) in results):
+                refresh_fare_calendar(db, sch['route_id'], sch['travel_date'])
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            for *_, future in batch:
+                future.set_exception(e)
+            return
+
+        self.booked = booked
+        self.booked_as_of = as_of
+        for future, (outcome, value) in results:
+            if outcome == 'booked':
+                mark_booking_valid(self.schedule_id, value)
+            future.set_result((outcome, value))
+
+def flash_sale_worker(schedule_id):
+    if schedule_id not in FLASH_SALE_SCHEDULES:
+        return None
+    with _flash_sale_lock:
+        worker = _flash_sale_workers.get(schedule_id)
+        if worker is None or not worker.is_alive():
+            worker = _flash_sale_workers[schedule_id] = ScheduleBookingWorker(schedule_id)
+            worker.start()
+        return worker
+
+def flash_sale_seats_released(schedule_id):
+    # Called after a cancellation commits so a freed seat isn't refused by admission control
+    with _flash_sale_lock:
+        worker = _flash_sale_workers.get(schedule_id)
+        if worker:
+            worker.releases += 1
+
+def set_flash_sale(schedule_id, enabled):
+    with _flash_sale_lock:
+        if enabled:
+            FLASH_SALE_SCHEDULES.add(schedule_id)
+            return
+        FLASH_SALE_SCHEDULES.discard(schedule_id)
+        worker = _flash_sale_workers.pop(schedule_id, None)
+    if worker:
+        worker.stop()
+
+def _retry_later(message):
+    resp = jsonify({"error": message, "retryAfter": FLASH_SALE_RETRY_AFTER})
+    resp.status_code = 503
+    resp.headers['Retry-After'] = str(FLASH_SALE_RETRY_AFTER)
+    return resp
+
+def _flash_sale_book(worker, user_id, seat_numbers, passengers):
+    # Admission control: seats known to be gone are rejected without queueing.
+    # After a cancellation everything queues until the worker's locked re-read catches up.
+    taken = None
+    if worker.booked_as_of == worker.releases:
+        taken = next((seat for seat in seat_numbers if seat in worker.booked), None)
+    if taken:
+        return jsonify({"error": f"Seat {taken} has just been booked by someone else. Please select another seat."}), 409
+
+    try:
+        future = worker.submit(user_id, seat_numbers, passengers)
+    except queue.Full:
+        return _retry_later("This departure is in very high demand. Please retry in a moment.")
+
+    try:
+        try:
+            outcome, value = future.result(timeout=FLASH_SALE_WAIT)
+        except FutureTimeout:
+            if future.cancel():
+                return _retry_later("Booking queue timed out. Please retry in a moment.")
+            outcome, value = future.result() # Already in a batch being committed
+    except sqlite3.OperationalError:
+        return _retry_later("Booking system busy. Please retry in a moment.")
+    except RuntimeError:
+        # The worker was stopped (flash sale turned off or departure cancelled) with this request queued
+        return _retry_later("Flash sale ended for this departure, please retry.")
+
+    if outcome == 'conflict':
+        return jsonify({"error": f"Seat {value} has just been booked by someone else. Please select another seat."}), 409
+    if outcome == 'cancelled':
+        return jsonify({"error": "This departure has been cancelled"}), 409
+
+    _send_ticket_email(get_db(), value)
+    return jsonify({"message": "Booking successful", "ticketId": value})
+
+# --- Group Booking ---
+GROUP_BOOKING_MAX_SEATS = 500
+
+@app.route('/api/book/group', methods=['POST'])
+def api_book_group():
+    if 'user_id' not in session:
+        return jsonify({"error": "Unauthorized. Please login."}), 401
+
+    idem_key = request.headers.get('Idempotency-Key')
+    if not idem_key:
+        return _create_group_booking(request.json)
+    if len(idem_key) > 255:
+        return jsonify({"error": "Idempotency-Key too long"}), 400
+
+    return _idempotent(session['user_id'], idem_key, lambda: _create_group_booking(request.json))
+
+def _create_group_booking(data):
+    # Payload: {"items": [{"scheduleId": 1, "seats": [...], "passengers": [...]}, ...]}
+    items = (data or {}).get('items')
+    if not items or not isinstance(items, list):
+        return jsonify({"error": "items must be a non-empty list"}), 400
+
+    requested = {}
+    for item in items:
+        if not isinstance(item, dict):
+            return jsonify({"error": "Each item must be an object"}), 400
+        schedule_id = item.get('scheduleId')
+        seat_numbers = item.get('seats') or []
+        passengers = item.get('passengers')
+        if not schedule_id or not seat_numbers:
+            return jsonify({"error": "Each item needs a scheduleId and seats"}), 400
+        if not isinstance(schedule_id, int) or isinstance(schedule_id, bool):
+            return jsonify({"error": "scheduleId must be an integer"}), 400
+        if not isinstance(seat_numbers, list) or not all(isinstance(seat, str) for seat in seat_numbers):
+            return jsonify({"error": f"seats for schedule {schedule_id} must be a list of seat numbers"}), 400
+        if passengers and (not isinstance(passengers, list) or not all(isinstance(p, dict) for p in passengers)):
+            return jsonify({"error": f"passengers for schedule {schedule_id} must be a list of objects"}), 400
+        if schedule_id in requested:
+            return jsonify({"error": f"Schedule {schedule_id} appears more than once"}), 400
+        if len(set(seat_numbers)) != len(seat_numbers):
+            return jsonify({"error": f"Duplicate seats requested for schedule {schedule_id}"}), 400
+        if passengers and len(passengers) != len(seat_numbers):
+            return jsonify({"error": f"Passenger details missing for some seats on schedule {schedule_id}"}), 400
+        if passengers and not all(p.get('name') and p.get('seat') for p in passengers):
+            return jsonify({"error": f"Each passenger on schedule {schedule_id} needs a name and seat"}), 400
+        requested[schedule_id] = (seat_numbers, passengers)
+
+    if sum(len(seats) for seats, _ in requested.values()) > GROUP_BOOKING_MAX_SEATS:
+        return jsonify({"error": f"A group booking is limited to {GROUP_BOOKING_MAX_SEATS} seats"}), 400
+
+    # Always walk schedules in id order so concurrent groups validate and insert deterministically
+    schedule_ids = sorted(requested)
+    placeholders = ','.join('?' * len(schedule_ids))
+    user_id = session['user_id']
+    db = get_db()
+
+    try:
+        # Take the write lock once, up front, for the whole group
+        db.execute("BEGIN IMMEDIATE")
+
+        cur = db.execute(f"SELECT id, price, route_id, travel_date FROM schedules WHERE id IN ({placeholders}) AND status != 'CANCELLED'", schedule_ids)
+        schedules = {row['id']: row for row in cur.fetchall()}
+        prices = {sid: row['price'] for sid, row in schedules.items()}
+        missing = [sid for sid in schedule_ids if sid not in prices]
+        if missing:
+            db.rollback()
+            return jsonify({"error": f"Schedule {missing[0]} not found"}), 404
+
+        # --- CRITICAL: Check for Double Booking across every schedule at once ---
+        cur = db.execute(f"SELECT schedule_id, seats FROM bookings WHERE schedule_id IN ({placeholders}) AND status = 'confirmed'",
+                         schedule_ids)
+        booked = {sid: set() for sid in schedule_ids}
+        for row in cur.fetchall():
+            booked[row['schedule_id']].update(json.loads(row['seats']))
+
+        for sid in schedule_ids:
+            taken = [seat for seat in requested[sid][0] if seat in booked[sid]]
+            if taken:
+                db.rollback()
+                return jsonify({"error": f"Seat {taken[0]} on schedule {sid} is no longer available. No seats were booked.",
+                                "scheduleId": sid}), 409
+        # ------------------------------------------------------------------------
+
+        group_total = sum(prices[sid] * len(requested[sid][0]) for sid in schedule_ids)
+        cur = db.execute("INSERT INTO booking_groups (user_id, total_amount) VALUES (?, ?)", (user_id, group_total))
+        group_id = cur.lastrowid
+
+        passenger_batch = []
+        new_bookings = []
+        for sid in schedule_ids:
+            seat_numbers, passengers = requested[sid]
+            cur = db.execute('''
+                INSERT INTO bookings (user_id, schedule_id, seats, total_amount, status, group_id)
+                VALUES (?, ?, ?, ?, 'confirmed', ?)
+            ''', (user_id, sid, json.dumps(seat_numbers), prices[sid] * len(seat_numbers), group_id))
+            passenger_batch.extend(passenger_rows(cur.lastrowid, passengers))
+            new_bookings.append((sid, cur.lastrowid))
+        db.executemany(INSERT_PASSENGER_SQL, passenger_batch)
+        for route_id, travel_date in {(row['route_id'], row['travel_date']) for row in schedules.values()}:
+            refresh_fare_calendar(db, route_id, travel_date)
+        db.commit()
+        for sid, booking_id in new_bookings:
+            mark_booking_valid(sid, booking_id)
+    except Exception as e:
+        db.rollback()
+        return jsonify({"error": str(e)}), 500
+
+    query = '''
+        SELECT bk.id, bk.schedule_id, bk.total_amount, bk.seats,
+               s.departure_time, s.travel_date,
+               r.from_city, r.to_city, bo.name as operator
+        FROM bookings bk
+        JOIN schedules s ON bk.schedule_id = s.id
+        JOIN routes r ON s.route_id = r.id
+        JOIN buses b ON s.bus_id = b.id
+        JOIN bus_operators bo ON b.operator_id = bo.id
+        WHERE bk.group_id = ?
+        ORDER BY s.travel_date, s.departure_time
+    '''
+    cur = db.execute(query, (group_id,))
+    bookings_data = [dict(row) for row in cur.fetchall()]
+    ticket_ids = [b['id'] for b in bookings_data]
+    passengers_by_booking = fetch_passengers(db, ticket_ids)
+    for b in bookings_data:
+        b['passengers'] = passengers_by_booking[b['id']]
+
+    # --- Send one consolidated ticket email ---
+    try:
+        user_email = session.get('user_email')
+        if user_email:
+            pdf_bytes = generate_group_ticket_pdf(bookings_data)
+            subject = f"Your Group Booking - {len(ticket_ids)} trips"
+            body = "Please find attached your tickets. PNRs: " + ", ".join(f"AB-{tid}" for tid in ticket_ids)
+            send_email(user_email, subject, body, attachment=(f"group_{group_id}.pdf", pdf_bytes))
+    except Exception as ex:
+        print(f"Email failed: {ex}")
+
+    return jsonify({"message": "Group booking successful", "groupId": group_id,
+                    "ticketIds": ticket_ids, "totalAmount": group_total})
+
 @app.route('/api/ticket/<int:id>')
 def api_ticket(id):
     if 'user_id' not in session:
         return jsonify({"error": "Unauthorized"}), 401
         
     query = '''
-        SELECT bk.id, bk.total_amount, bk.passengers, bk.seats,
+        SELECT bk.id, bk.schedule_id, bk.total_amount, bk.seats,
                s.departure_time, s.travel_date,
                r.from_city, r.to_city, bo.name as operator
-        FROM bookings bk
-        JOIN schedules s ON bk.schedule_id = s.id
+        FROM {schema}.bookings bk
+        JOIN {schema}.schedules s ON bk.schedule_id = s.id
         JOIN routes r ON s.route_id = r.id
         JOIN buses b ON s.bus_id = b.id
         JOIN bus_operators bo ON b.operator_id = bo.id
         WHERE bk.id = ? AND bk.user_id = ?
     '''
     db = get_db()
-    cur = db.execute(query, (id, session['user_id']))
+    cur = db.execute(query.format(schema='main'), (id, session['user_id']))
     row = cur.fetchone()
     if row:
         data = dict(row)
-        # Parse passengers if stored as string
-        if isinstance(data['passengers'], str):
-            data['passengers'] = json.loads(data['passengers'])
+        data['passengers'] = fetch_passengers(db, [id])[id]
+    else:
+        # Not live, so it may be an archived past trip (My Bookings lists those with ?history=1)
+        rows = query_with_archives(db, query, (id, session['user_id']), history=True)
+        data = rows[0] if rows else None
+        if data:
+            data['passengers'] = query_with_archives(db, '''
+                SELECT seat, name, age, gender, contact FROM {schema}.passengers WHERE booking_id = ? ORDER BY id
+            ''', (id,), history=True)
+    if data:
+        try:
+            data['qr'] = sign_ticket_payload(data['id'], data['schedule_id'], json.loads(data['seats']),
+                                             data['travel_date'], data['departure_time'])
+        except ValueError:
+            data['qr'] = None
         return jsonify(data)
     return jsonify({"error": "Ticket not found"}), 404
     
@@ -791,8 +2007,8 @@ def api_my_bookings():
         SELECT bk.id, bk.created_at, bk.total_amount, bk.status,
                r.from_city, r.to_city, s.travel_date, s.departure_time,
                bo.name as operator
-        FROM bookings bk
-        JOIN schedules s ON bk.schedule_id = s.id
+        FROM {schema}.bookings bk
+        JOIN {schema}.schedules s ON bk.schedule_id = s.id
         JOIN routes r ON s.route_id = r.id
         JOIN buses b ON s.bus_id = b.id
         JOIN bus_operators bo ON b.operator_id = bo.id
@@ -800,13 +2016,14 @@ def api_my_bookings():
         ORDER BY bk.created_at DESC
     '''
     db = get_db()
-    cur = db.execute(query, (session['user_id'],))
+    # Completed trips are archived, ?history=1 brings them back in
+    rows = query_with_archives(db, query, (session['user_id'],), _wants_history())
+    rows.sort(key=lambda b: b['created_at'] or '', reverse=True)
     
     bookings = []
     now = datetime.now()
     
-    for row in cur.fetchall():
-        b = dict(row)
+    for b in rows:
         # Calculate can_cancel
         try:
             # Parse travel date time
@@ -841,7 +2058,7 @@ def api_cancel_booking():
     
     # Check booking ownership and time
     query = '''
-        SELECT bk.id, bk.status, s.travel_date, s.departure_time
+        SELECT bk.id, bk.schedule_id, bk.status, s.route_id, s.travel_date, s.departure_time
         FROM bookings bk
         JOIN schedules s ON bk.schedule_id = s.id
         WHERE bk.id = ? AND bk.user_id = ?
@@ -864,9 +2081,14 @@ def api_cancel_booking():
     except ValueError:
         return jsonify({"error": "Invalid date format in record"}), 500
 
-    # Proceed to cancel
+    # Proceed to cancel, promoting waitlisted users into the freed seats in the same transaction
     db.execute("UPDATE bookings SET status = 'CANCELLED' WHERE id = ?", (booking_id,))
+    promoted = promote_waitlist(db, row['schedule_id'])
+    refresh_fare_calendar(db, row['route_id'], row['travel_date'])
     db.commit()
+    mark_booking_invalid(row['schedule_id'], row['id'])
+    flash_sale_seats_released(row['schedule_id'])
+    waitlist_promoted(row['schedule_id'], promoted)
     
     # Send Email Notification
     try:
@@ -880,19 +2102,222 @@ def api_cancel_booking():
     
     return jsonify({"success": True, "message": "Booking cancelled successfully"})
 
+# --- Waitlist ---
+# The waitlist table is the source of truth. An in-memory deque per schedule
+# mirrors it so queue positions and the common "nobody is waiting" cancel path
+# skip the database. The TTL bounds drift from other processes.
+WAITLIST_MIRROR_TTL = 60
+_waitlists = {} # schedule_id -> (loaded_at, deque of (waitlist_id, user_id, seats_requested))
+_waitlists_lock = threading.Lock()
+
+def seat_labels(total_seats):
+    # Same 4-across layout as the seat map: 1A, 1B, 1C, 1D, 2A, ...
+    return [f"{i // len(SEAT_COLUMNS) + 1}{SEAT_COLUMNS[i % len(SEAT_COLUMNS)]}" for i in range(total_seats)]
+
+def booked_seats_for(db, schedule_id):
+    cur = db.execute("SELECT seats FROM bookings WHERE schedule_id = ? AND status = 'confirmed'", (schedule_id,))
+    booked = set()
+    for row in cur.fetchall():
+        booked.update(json.loads(row['seats']))
+    return booked
+
+def _waitlist_queue(db, schedule_id):
+    now = time.monotonic()
+    with _waitlists_lock:
+        entry = _waitlists.get(schedule_id)
+        if entry and now - entry[0] < WAITLIST_MIRROR_TTL:
+            return entry[1]
+
+    cur = db.execute("SELECT id, user_id, seats_requested FROM waitlist WHERE schedule_id = ? AND status = 'waiting' ORDER BY id",
+                     (schedule_id,))
+    queue = deque(tuple(row) for row in cur.fetchall())
+    with _waitlists_lock:
+        _waitlists[schedule_id] = (now, queue)
+    return queue
+
+def _waitlist_remove(schedule_id, waitlist_ids):
+    with _waitlists_lock:
+        entry = _waitlists.get(schedule_id)
+        if entry:
+            remaining = [item for item in entry[1] if item[0] not in waitlist_ids]
+            entry[1].clear()
+            entry[1].extend(remaining)
+
+def promote_waitlist(db, schedule_id):
+    """Book freed seats for waitlisted users, strictly first in first out.
+
+    Must run inside the caller's write transaction, after the seats were released.
+    Returns the promotions for waitlist_promoted() to apply once committed.
+    """
+    if not _waitlist_queue(db, schedule_id):
+        return []
+
+    cur = db.execute('''
+        SELECT s.price, b.total_seats FROM schedules s JOIN buses b ON s.bus_id = b.id WHERE s.id = ?
+    ''', (schedule_id,))
+    sch = cur.fetchone()
+    booked = booked_seats_for(db, schedule_id)
+    free = [seat for seat in seat_labels(sch['total_seats']) if seat not in booked]
+
+    cur = db.execute('''
+        SELECT w.id, w.user_id, w.seats_requested, w.passengers, u.email
+        FROM waitlist w JOIN users u ON w.user_id = u.id
+        WHERE w.schedule_id = ? AND w.status = 'waiting'
+        ORDER BY w.id
+    ''', (schedule_id,))
+
+    promoted = []
+    for entry in cur.fetchall():
+        if entry['seats_requested'] > len(free):
+            break # Never skip the head of the queue
+        seats = free[:entry['seats_requested']]
+        # A savepoint per promotion, so a bad waitlist row can never undo the caller's cancellation
+        db.execute("SAVEPOINT promote")
+        try:
+            bk = db.execute('''
+                INSERT INTO bookings (user_id, schedule_id, seats, total_amount, status)
+                VALUES (?, ?, ?, ?, 'confirmed')
+            ''', (entry['user_id'], schedule_id, json.dumps(seats), sch['price'] * len(seats)))
+            try:
+                passengers = json.loads(entry['passengers']) if entry['passengers'] else []
+            except ValueError:
+                passengers = []
+            # Rows from before join-time validation may lack names; book the seats without them
+            passengers = [p for p in passengers if isinstance(p, dict) and p.get('name')][:len(seats)]
+            for p, seat in zip(passengers, seats):
+                p['seat'] = seat
+            db.executemany(INSERT_PASSENGER_SQL, passenger_rows(bk.lastrowid, passengers))
+            db.execute("UPDATE waitlist SET status = 'promoted', booking_id = ? WHERE id = ?", (bk.lastrowid, entry['id']))
+            db.execute("RELEASE SAVEPOINT promote")
+        except Exception as e:
+            db.execute("ROLLBACK TO SAVEPOINT promote")
+            db.execute("RELEASE SAVEPOINT promote")
+            print(f"Waitlist promotion {entry['id']} on schedule {schedule_id} failed: {e}")
+            break
+        free = free[entry['seats_requested']:]
+        promoted.append({"waitlist_id": entry['id'], "booking_id": bk.lastrowid, "email": entry['email'], "seats": seats})
+    return promoted
+
+def waitlist_promoted(schedule_id, promoted):
+    # After commit: sync the mirror and notify without blocking the request
+    if not promoted:
+        return
+    _waitlist_remove(schedule_id, {p['waitlist_id'] for p in promoted})
+    for p in promoted:
+        mark_booking_valid(schedule_id, p['booking_id'])
+        if p['email']:
+            subject = f"You're off the waitlist - PNR: AB-{p['booking_id']}"
+            body = f"Good news! Seats {', '.join(p['seats'])} have been booked for you under PNR AB-{p['booking_id']}."
+            queue_email(p['email'], subject, body)
+
+@app.route('/api/waitlist/<int:schedule_id>', methods=['GET', 'POST', 'DELETE'])
+def api_waitlist(schedule_id):
+    if 'user_id' not in session:
+        return jsonify({"error": "Unauthorized. Please login."}), 401
+
+    user_id = session['user_id']
+    db = get_db()
+    queue = _waitlist_queue(db, schedule_id)
+
+    if request.method == 'GET':
+        position = next((i + 1 for i, item in enumerate(list(queue)) if item[1] == user_id), None)
+        return jsonify({"scheduleId": schedule_id, "position": position, "length": len(queue)})
+
+    if request.method == 'DELETE':
+        cur = db.execute("UPDATE waitlist SET status = 'left' WHERE schedule_id = ? AND user_id = ? AND status = 'waiting'",
+                         (schedule_id, user_id))
+        db.commit()
+        if cur.rowcount == 0:
+            return jsonify({"error": "You are not on this waitlist"}), 404
+        with _waitlists_lock:
+            _waitlists.pop(schedule_id, None) # Reload on next access
+        return jsonify({"message": "Removed from waitlist"})
+
+    # POST: join the queue. Payload: {"seats": 2, "passengers": [...]}
+    data = request.json or {}
+    passengers = data.get('passengers')
+    try:
+        seats_requested = int(data.get('seats') or (len(passengers) if passengers else 1))
+    except (TypeError, ValueError):
+        return jsonify({"error": "seats must be a number"}), 400
+    if seats_requested < 1:
+        return jsonify({"error": "seats must be at least 1"}), 400
+    if passengers and len(passengers) != seats_requested:
+        return jsonify({"error": "Passenger details missing for some seats"}), 400
+    # Seats are assigned at promotion time, so only the name is required here
+    if passengers and not all(isinstance(p, dict) and p.get('name') for p in passengers):
+        return jsonify({"error": "Each passenger needs a name"}), 400
+
+    cur = db.execute("SELECT b.total_seats FROM schedules s JOIN buses b ON s.bus_id = b.id WHERE s.id = ? AND s.status != 'CANCELLED'", (schedule_id,))
+    sch = cur.fetchone()
+    if not sch:
+        return jsonify({"error": "Schedule not found"}), 404
+    if seats_requested > sch['total_seats']:
+        return jsonify({"error": "More seats requested than the bus has"}), 400
+    if sch['total_seats'] - len(booked_seats_for(db, schedule_id)) >= seats_requested:
+        return jsonify({"error": "Seats are available, please book directly"}), 409
+    if any(item[1] == user_id for item in list(queue)):
+        return jsonify({"error": "You are already on this waitlist"}), 409
+
+    try:
+        cur = db.execute("INSERT INTO waitlist (schedule_id, user_id, seats_requested, passengers) VALUES (?, ?, ?, ?)",
+                         (schedule_id, user_id, seats_requested, json.dumps(passengers) if passengers else None))
+        db.commit()
+    except sqlite3.IntegrityError:
+        return jsonify({"error": "You are already on this waitlist"}), 409
+    with _waitlists_lock:
+        queue.append((cur.lastrowid, user_id, seats_requested))
+        position = len(queue)
+    return jsonify({"message": "Added to waitlist", "waitlistId": cur.lastrowid, "position": position})
+
+VERIFY_MAX_SCANS = 1000
+
+@app.route('/api/verify-ticket', methods=['POST'])
+@admin_required
+def api_verify_ticket():
+    # Payload: {"scans": ["AB1...", ...], "scheduleId": optional bus being boarded}
+    data = request.json or {}
+    scans = data.get('scans') or ([data['code']] if data.get('code') else [])
+    if not scans or not isinstance(scans, list):
+        return jsonify({"error": "scans must be a non-empty list"}), 400
+    if len(scans) > VERIFY_MAX_SCANS:
+        return jsonify({"error": f"At most {VERIFY_MAX_SCANS} scans per request"}), 400
+    boarding_schedule = data.get('scheduleId')
+
+    db = get_db()
+    now = int(time.time())
+    results = []
+    for code in scans:
+        try:
+            ticket = decode_ticket_payload(code)
+        except ValueError as e:
+            results.append({"code": code, "valid": False, "reason": str(e)})
+            continue
+
+        result = {"code": code, **ticket}
+        if ticket['expiry'] < now:
+            result.update(valid=False, reason="expired")
+        elif boarding_schedule and ticket['scheduleId'] != boarding_schedule:
+            result.update(valid=False, reason="wrong_schedule")
+        elif ticket['bookingId'] not in valid_bookings_for(db, ticket['scheduleId']):
+            result.update(valid=False, reason="cancelled_or_unknown")
+        else:
+            result.update(valid=True, reason=None)
+        results.append(result)
+
+    return jsonify({"results": results, "valid": sum(1 for r in results if r['valid'])})
+
 # --- Admin APIs ---
 
 @app.route('/api/admin/stats')
 @admin_required
 def admin_stats():
     db = get_db()
-    # Total Bookings
-    cur = db.execute("SELECT count(*) FROM bookings")
-    total_bookings = cur.fetchone()[0]
-    
-    # Total Revenue (Approx)
-    cur = db.execute("SELECT sum(total_amount) FROM bookings")
-    total_revenue = cur.fetchone()[0] or 0
+    # Total Bookings / Revenue (Approx), archived trips included with ?history=1
+    totals = query_with_archives(db, "SELECT count(*) as n, sum(total_amount) as revenue FROM {schema}.bookings",
+                                 history=_wants_history())
+    total_bookings = sum(t['n'] for t in totals)
+    total_revenue = sum(t['revenue'] or 0 for t in totals)
     
     # Active Routes
     cur = db.execute("SELECT count(*) FROM routes")
@@ -912,15 +2337,154 @@ def admin_get_bookings():
     query = '''
         SELECT bk.id, bk.created_at, u.name as user_name, r.from_city, r.to_city, 
                s.travel_date, bk.total_amount, bk.status
-        FROM bookings bk
+        FROM {schema}.bookings bk
         JOIN users u ON bk.user_id = u.id
-        JOIN schedules s ON bk.schedule_id = s.id
+        JOIN {schema}.schedules s ON bk.schedule_id = s.id
         JOIN routes r ON s.route_id = r.id
         ORDER BY bk.created_at DESC LIMIT 50
     '''
-    cur = db.execute(query)
-    bookings = [dict(row) for row in cur.fetchall()]
-    return jsonify(bookings)
+    bookings = query_with_archives(db, query, history=_wants_history())
+    bookings.sort(key=lambda b: b['created_at'] or '', reverse=True)
+    return jsonify(bookings[:50])
+
+@app.route('/api/admin/archive', methods=['POST'])
+@admin_required
+def admin_archive():
+    before = (request.json or {}).get('before') if request.is_json else None
+    if before:
+        try:
+            datetime.strptime(before, '%Y-%m-%d')
+        except ValueError:
+            return jsonify({"error": "before must be YYYY-MM-DD"}), 400
+    start = time.perf_counter()
+    stats = archive_completed_trips(get_db(), before)
+    stats["seconds"] = round(time.perf_counter() - start, 3)
+    return jsonify(stats)
+
+@app.route('/api/admin/backups', methods=['GET', 'POST'])
+@admin_required
+def admin_backups():
+    if request.method == 'POST':
+        if not start_backup_job():
+            return jsonify({"error": "A backup is already running", "job": dict(_backup_job)}), 409
+        return jsonify({"message": "Backup started", "job": dict(_backup_job)}), 202
+
+    return jsonify({"job": dict(_backup_job) or None,
+                    "backups": [{"path": path, "bytes": os.path.getsize(path)} for path in list_backups()]})
+
+@app.route('/api/admin/bookings/search')
+@admin_required
+def admin_search_bookings():
+    q = (request.args.get('q') or '').strip()
+    if not q:
+        return jsonify({"error": "q is required"}), 400
+    try:
+        limit = min(int(request.args.get('limit', BOOKING_SEARCH_LIMIT)), 200)
+    except ValueError:
+        return jsonify({"error": "limit must be a number"}), 400
+
+    select = '''
+        SELECT bk.id, 'AB-' || bk.id as pnr, bk.created_at, bk.status, bk.total_amount,
+               u.name as user_name, u.email as user_email,
+               r.from_city, r.to_city, s.travel_date, s.departure_time,
+               f.passenger_names, f.passenger_contacts
+        FROM bookings_fts f
+        JOIN bookings bk ON bk.id = f.rowid
+        JOIN users u ON bk.user_id = u.id
+        JOIN schedules s ON bk.schedule_id = s.id
+        JOIN routes r ON s.route_id = r.id
+    '''
+    db = get_db()
+    start = time.perf_counter()
+    try:
+        # An exact PNR is a rowid lookup and always comes first, however many prefix matches rank above it
+        exact_id = pnr_booking_id(q)
+        results = []
+        if exact_id is not None:
+            cur = db.execute(f"{select} WHERE f.rowid = ?", (exact_id,))
+            results = [dict(row) for row in cur.fetchall()]
+        seen = [row['id'] for row in results]
+        cur = db.execute(f'''{select}
+            WHERE bookings_fts MATCH ? AND f.rowid NOT IN ({','.join('?' * len(seen))})
+            ORDER BY f.rank
+            LIMIT ?
+        ''', (build_fts_query(q), *seen, max(limit - len(seen), 0)))
+    except sqlite3.OperationalError as e:
+        return jsonify({"error": f"Search unavailable: {e}"}), 503
+    results += [dict(row) for row in cur.fetchall()]
+    return jsonify({"query": q, "results": results,
+                    "took_ms": round((time.perf_counter() - start) * 1000, 2)})
+
+@app.route('/api/admin/flash-sale', methods=['GET', 'POST'])
+@admin_required
+def admin_flash_sale():
+    if request.method == 'POST':
+        data = request.json or {}
+        schedule_id = data.get('scheduleId')
+        if not isinstance(schedule_id, int):
+            return jsonify({"error": "scheduleId is required"}), 400
+        set_flash_sale(schedule_id, bool(data.get('enabled', True)))
+
+    with _flash_sale_lock:
+        workers = dict(_flash_sale_workers)
+    return jsonify([{"scheduleId": sid,
+                     "queueDepth": workers[sid].requests.qsize() if sid in workers else 0,
+                     "workerAlive": sid in workers and workers[sid].is_alive()}
+                    for sid in sorted(FLASH_SALE_SCHEDULES)])
+
+@app.route('/api/admin/schedules/<int:schedule_id>/manifest')
+@admin_required
+def admin_schedule_manifest(schedule_id):
+    db = get_db()
+    query = '''
+        SELECT p.seat, p.name, p.age, p.gender, p.contact, bk.id as booking_id
+        FROM bookings bk
+        JOIN passengers p ON p.booking_id = bk.id
+        WHERE bk.schedule_id = ? AND bk.status = 'confirmed'
+    '''
+    cur = db.execute(query, (schedule_id,))
+    rows = sorted(cur.fetchall(), key=lambda row: _seat_sort_key(row['seat'] or ''))
+    return jsonify([dict(row) for row in rows])
+
+@app.route('/api/admin/manifests')
+@admin_required
+def admin_day_manifests():
+    travel_date = request.args.get('date') or datetime.now().strftime('%Y-%m-%d')
+    try:
+        datetime.strptime(travel_date, '%Y-%m-%d')
+    except ValueError:
+        return jsonify({"error": "date must be YYYY-MM-DD"}), 400
+
+    zip_bytes, stats = generate_day_manifests(get_db(), travel_date, request.args.get('operator'))
+    print(f"Manifests {travel_date}: {stats['manifests']} in {stats['seconds']}s ({stats['manifests_per_sec']} manifests/sec)")
+
+    resp = send_file(io.BytesIO(zip_bytes), mimetype='application/zip', as_attachment=True,
+                     download_name=f"manifests_{travel_date}.zip")
+    resp.headers['X-Manifest-Count'] = str(stats['manifests'])
+    resp.headers['X-Manifests-Per-Sec'] = str(stats['manifests_per_sec'])
+    resp.headers['X-Manifest-Failed-PDFs'] = str(stats['failed_pdfs'])
+    return resp
+
+@app.route('/api/admin/passengers')
+@admin_required
+def admin_find_passengers():
+    contact = request.args.get('contact')
+    if not contact:
+        return jsonify({"error": "contact is required"}), 400
+
+    db = get_db()
+    query = '''
+        SELECT bk.id as booking_id, bk.status, p.seat, p.name, p.age, p.gender, p.contact,
+               r.from_city, r.to_city, s.travel_date, s.departure_time
+        FROM passengers p
+        JOIN bookings bk ON p.booking_id = bk.id
+        JOIN schedules s ON bk.schedule_id = s.id
+        JOIN routes r ON s.route_id = r.id
+        WHERE p.contact = ?
+        ORDER BY s.travel_date DESC
+    '''
+    cur = db.execute(query, (contact,))
+    return jsonify([dict(row) for row in cur.fetchall()])
 
 @app.route('/api/admin/routes', methods=['GET', 'POST'])
 @admin_required
@@ -980,9 +2544,350 @@ def admin_add_schedule():
         INSERT INTO schedules (bus_id, route_id, departure_time, arrival_time, travel_date, price)
         VALUES (?, ?, ?, ?, ?, ?)
     ''', (bus_id, route_id, dep_time, arr_time, travel_date, price))
+    refresh_fare_calendar(db, route_id, travel_date)
     db.commit()
     return jsonify({"message": "Schedule added"})
 
+# --- Bulk Schedule Cancellation ---
+CANCELLATION_EMAIL_BATCH = 50
+
+def _send_email_batch(messages):
+    for to_email, subject, body in messages:
+        try:
+            send_email(to_email, subject, body)
+        except Exception as e:
+            print(f"Failed to send cancellation email to {to_email}: {e}")
+
+@app.route('/api/admin/schedules/cancel', methods=['POST'])
+@admin_required
+def admin_cancel_schedules():
+    # Payload: {"scheduleId": 1} or {"scheduleIds": [1, 2]} or {"routeId": 3, "fromDate": "...", "toDate": "..."}
+    data = request.json or {}
+    reason = (data.get('reason') or 'operational reasons').strip()
+    start = time.perf_counter()
+    db = get_db()
+
+    # Validate the payload before taking the write lock
+    ids = None
+    if 'scheduleIds' in data or 'scheduleId' in data:
+        ids = data['scheduleIds'] if 'scheduleIds' in data else [data['scheduleId']]
+        if not isinstance(ids, list) or not ids or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+            return jsonify({"error": "scheduleIds must be a non-empty list of integer ids"}), 400
+    elif data.get('routeId') and data.get('fromDate'):
+        if not isinstance(data['routeId'], int) or isinstance(data['routeId'], bool):
+            return jsonify({"error": "routeId must be an integer"}), 400
+        try:
+            for key in ('fromDate', 'toDate'):
+                if data.get(key) is not None:
+                    datetime.strptime(data[key], '%Y-%m-%d')
+        except (TypeError, ValueError):
+            return jsonify({"error": "fromDate/toDate must be YYYY-MM-DD"}), 400
+    else:
+        return jsonify({"error": "Provide scheduleId, scheduleIds, or routeId with fromDate/toDate"}), 400
+
+    # Only departures that haven't left yet can be cancelled (and refunded)
+    now = datetime.now().strftime('%Y-%m-%d %H:%M')
+    upcoming = "status != 'CANCELLED' AND travel_date || ' ' || departure_time > ?"
+
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        if ids is not None:
+            placeholders = ','.join('?' * len(ids))
+            cur = db.execute(f"SELECT id, route_id, travel_date FROM schedules WHERE id IN ({placeholders}) AND {upcoming}", (*ids, now))
+            schedules = cur.fetchall()
+            skipped = sorted(set(ids) - {s['id'] for s in schedules})
+            if skipped:
+                db.rollback()
+                return jsonify({"error": f"Schedule {skipped[0]} not found, already cancelled or already departed",
+                                "scheduleIds": skipped}), 400
+        else:
+            cur = db.execute(f'''
+                SELECT id, route_id, travel_date FROM schedules
+                WHERE route_id = ? AND travel_date BETWEEN ? AND ? AND {upcoming}
+            ''', (data['routeId'], data['fromDate'], data.get('toDate') or data['fromDate'], now))
+            schedules = cur.fetchall()
+        if not schedules:
+            db.rollback()
+            return jsonify({"error": "No upcoming schedules matched"}), 404
+
+        schedule_ids = [s['id'] for s in schedules]
+        placeholders = ','.join('?' * len(schedule_ids))
+        cur = db.execute(f'''
+            SELECT bk.id, bk.schedule_id, bk.total_amount, u.email, r.from_city, r.to_city, s.travel_date, s.departure_time
+            FROM bookings bk
+            JOIN users u ON bk.user_id = u.id
+            JOIN schedules s ON bk.schedule_id = s.id
+            JOIN routes r ON s.route_id = r.id
+            WHERE bk.schedule_id IN ({placeholders}) AND bk.status = 'confirmed'
+        ''', schedule_ids)
+        affected = cur.fetchall()
+        cur = db.execute(f'''
+            SELECT w.id, u.email, r.from_city, r.to_city, s.travel_date, s.departure_time
+            FROM waitlist w
+            JOIN users u ON w.user_id = u.id
+            JOIN schedules s ON w.schedule_id = s.id
+            JOIN routes r ON s.route_id = r.id
+            WHERE w.schedule_id IN ({placeholders}) AND w.status = 'waiting'
+        ''', schedule_ids)
+        waiting = cur.fetchall()
+
+        # One set-based UPDATE per table instead of a round trip per booking
+        db.execute(f"UPDATE bookings SET status = 'CANCELLED' WHERE schedule_id IN ({placeholders}) AND status = 'confirmed'", schedule_ids)
+        db.execute(f"UPDATE schedules SET status = 'CANCELLED' WHERE id IN ({placeholders})", schedule_ids)
+        db.execute(f"UPDATE waitlist SET status = 'cancelled' WHERE schedule_id IN ({placeholders}) AND status = 'waiting'", schedule_ids)
+        for route_id, travel_date in {(s['route_id'], s['travel_date']) for s in schedules}:
+            refresh_fare_calendar(db, route_id, travel_date)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    # After commit: drop in-memory state for the departures and notify
+    for schedule_id in schedule_ids:
+        set_flash_sale(schedule_id, False)
+        with _waitlists_lock:
+            _waitlists.pop(schedule_id, None)
+    for bk in affected:
+        mark_booking_invalid(bk['schedule_id'], bk['id'])
+
+    # One email per user covering all their cancelled bookings and waitlist places
+    per_user = {}
+    for bk in affected:
+        if bk['email']:
+            per_user.setdefault(bk['email'], ([], []))[0].append(bk)
+    for w in waiting:
+        if w['email']:
+            per_user.setdefault(w['email'], ([], []))[1].append(w)
+    messages = []
+    for email, (bks, waits) in per_user.items():
+        body = f"We're sorry, the following departure(s) were cancelled due to {reason}:\n\n"
+        if bks:
+            body += "\n".join(f"AB-{bk['id']}: {bk['from_city']} -> {bk['to_city']} on {bk['travel_date']} {bk['departure_time']} (Rs. {bk['total_amount']})"
+                              for bk in bks)
+            body += f"\n\nA full refund of Rs. {sum(bk['total_amount'] for bk in bks)} will be transferred to your account within 2 working days."
+        if waits:
+            body += "\n\n" if bks else ""
+            body += "You have been removed from the waitlist for:\n" + "\n".join(
+                f"{w['from_city']} -> {w['to_city']} on {w['travel_date']} {w['departure_time']}" for w in waits)
+        subject = f"{len(bks)} bookings cancelled" if len(bks) > 1 else "Your bus has been cancelled"
+        messages.append((email, subject, body))
+    for i in range(0, len(messages), CANCELLATION_EMAIL_BATCH):
+        _mail_pool.submit(_send_email_batch, messages[i:i + CANCELLATION_EMAIL_BATCH])
+
+    return jsonify({
+        "message": "Schedules cancelled",
+        "schedules": len(schedule_ids),
+        "bookings": len(affected),
+        "refundTotal": sum(bk['total_amount'] for bk in affected),
+        "waitlistCleared": len(waiting),
+        "emailsQueued": len(messages),
+        "seconds": round(time.perf_counter() - start, 3),
+    })
+
+# --- Sampling Profiler ---
+# Statistical profiler built on sys._current_frames(): every interval we grab
+# the stack of each live thread and count identical stacks. Output is the
+# collapsed-stack format ("frame;frame;frame count") read by flamegraph.pl,
+# speedscope and friends. Nothing runs unless an admin asks for it.
+import sys
+import itertools
+from collections import Counter
+
+PROFILER_MAX_SECONDS = 30
+PROFILER_DEFAULT_INTERVAL = 0.005
+PROFILE_HEADER = 'X-Profile'
+_profiler_lock = threading.Lock() # One whole-process capture at a time
+_request_profiles = deque(maxlen=50) # Recent per-request captures
+_request_profile_ids = itertools.count(1)
+
+def _collapse_stack(frame, thread_name=None):
+    labels = []
+    while frame is not None:
+        code = frame.f_code
+        labels.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    if thread_name:
+        labels.append(thread_name)
+    return ';'.join(reversed(labels))
+
+def sample_stacks(seconds, interval=PROFILER_DEFAULT_INTERVAL):
+    """Sample every other thread's stack for `seconds`. Returns (Counter of collapsed stacks, sample rounds)."""
+    me = threading.get_ident()
+    stacks = Counter()
+    rounds = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident != me:
+                stacks[_collapse_stack(frame, names.get(ident, str(ident)))] += 1
+        rounds += 1
+        time.sleep(interval)
+    return stacks, rounds
+
+def render_collapsed(stacks):
+    return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+def top_functions(stacks, limit=25):
+    # Self samples (leaf frame) and total samples (anywhere on the stack) per function
+    self_counts, total_counts = Counter(), Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(';')
+        self_counts[frames[-1]] += count
+        for frame in set(frames):
+            total_counts[frame] += count
+    return [{"frame": frame, "self": count, "total": total_counts[frame]} for frame, count in self_counts.most_common(limit)]
+
+class RequestSampler(threading.Thread):
+    """Samples a single request thread until stopped (or PROFILER_MAX_SECONDS)."""
+
+    def __init__(self, target_ident, interval):
+        super().__init__(name='profiler', daemon=True)
+        self.target_ident = target_ident
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        deadline = time.monotonic() + PROFILER_MAX_SECONDS
+        while not self._stop_event.wait(self.interval) and time.monotonic() < deadline:
+            frame = sys._current_frames().get(self.target_ident)
+            if frame is None or self._stop_event.is_set():
+                break # Don't count the request thread waiting on stop()
+            self.stacks[_collapse_stack(frame)] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+def _is_admin_session():
+    if 'user_id' not in session:
+        return False
+    user = get_db().execute("SELECT is_admin FROM users WHERE id = ?", (session['user_id'],)).fetchone()
+    return bool(user and user['is_admin'])
+
+@app.before_request
+def _start_request_profile():
+    # A single header lookup is all this costs when profiling is off
+    if PROFILE_HEADER not in request.headers or not _is_admin_session():
+        return
+    try:
+        interval = max(float(request.headers.get(PROFILE_HEADER)), 0.001)
+    except ValueError:
+        interval = PROFILER_DEFAULT_INTERVAL # Any other value (e.g. "1") just turns it on
+    if interval >= 1:
+        interval = PROFILER_DEFAULT_INTERVAL
+    g._profiler = RequestSampler(threading.get_ident(), interval)
+    g._profile_started = time.perf_counter()
+    g._profiler.start()
+
+@app.after_request
+def _finish_request_profile(response):
+    sampler = g.pop('_profiler', None)
+    if sampler is None:
+        return response
+    sampler.stop()
+    profile_id = next(_request_profile_ids)
+    _request_profiles.append({
+        "id": profile_id,
+        "method": request.method,
+        "path": request.full_path.rstrip('?'),
+        "status": response.status_code,
+        "seconds": round(time.perf_counter() - g.pop('_profile_started'), 4),
+        "samples": sampler.samples,
+        "stacks": sampler.stacks,
+    })
+    response.headers['X-Profile-Id'] = str(profile_id)
+    response.headers['X-Profile-Samples'] = str(sampler.samples)
+    return response
+
+def _profile_response(stacks, meta):
+    if request.args.get('format') == 'json':
+        return jsonify({**meta, "top": top_functions(stacks), "stacks": len(stacks)})
+    return Response(render_collapsed(stacks), mimetype='text/plain')
+
+@app.route('/api/admin/profile')
+@admin_required
+def admin_profile():
+    # Whole-process capture: /api/admin/profile?seconds=5&interval=0.005[&format=json]
+    try:
+        seconds = min(float(request.args.get('seconds', 5)), PROFILER_MAX_SECONDS)
+        interval = max(float(request.args.get('interval', PROFILER_DEFAULT_INTERVAL)), 0.001)
+    except ValueError:
+        return jsonify({"error": "seconds and interval must be numbers"}), 400
+    if seconds <= 0:
+        return jsonify({"error": "seconds must be positive"}), 400
+
+    if not _profiler_lock.acquire(blocking=False):
+        return jsonify({"error": "A profile is already being captured"}), 409
+    try:
+        stacks, rounds = sample_stacks(seconds, interval)
+    finally:
+        _profiler_lock.release()
+    return _profile_response(stacks, {"seconds": seconds, "interval": interval, "rounds": rounds,
+                                      "samples": sum(stacks.values())})
+
+@app.route('/api/admin/profile/requests')
+@admin_required
+def admin_request_profiles():
+    return jsonify([{k: v for k, v in p.items() if k != 'stacks'} for p in reversed(_request_profiles)])
+
+@app.route('/api/admin/profile/requests/<int:profile_id>')
+@admin_required
+def admin_request_profile(profile_id):
+    profile = next((p for p in _request_profiles if p['id'] == profile_id), None)
+    if not profile:
+        return jsonify({"error": "Profile not found"}), 404
+    return _profile_response(profile['stacks'], {k: v for k, v in profile.items() if k != 'stacks'})
+
+# --- CLI Commands ---
+import click
+
+@app.cli.command('manifests')
+@click.option('--date', 'travel_date', default=None, help='Travel date (YYYY-MM-DD), defaults to today.')
+@click.option('--operator', default=None, help='Only this operator.')
+@click.option('--workers', default=None, type=int, help='Render processes (defaults to CPU count).')
+@click.option('--out', default=None, help='Output zip path.')
+def manifests_command(travel_date, operator, workers, out):
+    """Generate the day's boarding manifests (PDF + CSV per departure) as a zip."""
+    travel_date = travel_date or datetime.now().strftime('%Y-%m-%d')
+    zip_bytes, stats = generate_day_manifests(get_db(), travel_date, operator, workers)
+    out = out or f"manifests_{travel_date}.zip"
+    with open(out, 'wb') as f:
+        f.write(zip_bytes)
+    print(f"Wrote {stats['manifests']} manifests ({stats['passengers']} passengers) to {out} "
+          f"in {stats['seconds']}s - {stats['manifests_per_sec']} manifests/sec")
+    if stats['failed_pdfs']:
+        print(f"{stats['failed_pdfs']} manifest PDFs failed to render, see the log above (their CSVs are included)")
+
+@app.cli.command('archive')
+@click.option('--before', default=None, help='Archive trips before this date (YYYY-MM-DD), defaults to today.')
+def archive_command(before):
+    """Move completed trips and their bookings into monthly archive databases."""
+    start = time.perf_counter()
+    stats = archive_completed_trips(get_db(), before)
+    print(f"Archived {stats['schedules']} schedules, {stats['bookings']} bookings, {stats['passengers']} passengers "
+          f"from {len(stats['months'])} months in {time.perf_counter() - start:.2f}s")
+
+@app.cli.command('backup')
+def backup_command():
+    """Take an online, compressed snapshot of the database."""
+    stats = backup_database()
+    print(f"Wrote {stats['path']} ({stats['bytes']} bytes, sha256 {stats['sha256'][:12]}...) in {stats['seconds']}s "
+          f"(journal_mode={stats['journal_mode']}); max writer stall {stats['max_writer_stall_ms']}ms over {stats['writer_probes']} probes")
+    for path in stats['rotated']:
+        print(f"Rotated out {path}")
+
+@app.cli.command('restore')
+@click.argument('snapshot')
+@click.option('--target', default=None, help='Database to restore into, defaults to the live database.')
+def restore_command(snapshot, target):
+    """Restore a snapshot after verifying its checksum and integrity."""
+    stats = restore_database(snapshot, target)
+    print(f"Restored {stats['restored']} from {stats['from']} (integrity: {stats['integrity']})")
+
 if __name__ == '__main__':
     init_db() # Ensure tables/columns exist
     seed_data()
@@ -0,0 +1,281 @@
+"""Reproducible performance benchmarks for AutoBusBook.
+
+Builds a synthetic database at the requested scale (using the schema from
+app.init_db), then drives the real Flask views through the test client from
+several threads and prints latency percentiles / throughput as JSON.
+
+    python benchmark.py --routes 22 --days 30 --bookings-per-schedule 10 --out bench.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+# Emails are mocked so the benchmark measures the app, not an SMTP server
+os.environ['SMTP_SERVER'] = 'localhost'
+
+import app as autobus
+
+CITIES = ['Delhi', 'Mumbai', 'Pune', 'Bangalore', 'Goa', 'Chennai', 'Hyderabad', 'Kolkata',
+          'Jaipur', 'Lucknow', 'Bhopal', 'Indore', 'Surat', 'Agra', 'Manali', 'Mysuru']
+SEATS = [f"{row}{col}" for row in range(1, 11) for col in 'ABCD']
+# generate_db leaves the last 8 seats of every bus free, split between the two booking scenarios
+BOOK_SEATS = SEATS[-8:-4]
+RACE_SEATS = SEATS[-4:]
+
+
+# --- Synthetic Data ---
+def generate_db(path, routes, days, bookings_per_schedule, users=200, seed=42):
+    """Create a fresh database at path with a deterministic synthetic data set."""
+    rng = random.Random(seed)
+    if os.path.exists(path):
+        os.remove(path)
+    autobus.DB_NAME = path
+    autobus.init_db()
+
+    db = sqlite3.connect(path)
+    db.execute("INSERT INTO users (email, name, phone, is_admin) VALUES ('admin@bench.local', 'Bench Admin', '000', 1)")
+    db.executemany("INSERT INTO users (email, name, phone) VALUES (?, ?, ?)",
+                   [(f"user{i}@bench.local", f"User {i}", f"9{i:09d}") for i in range(users)])
+    user_ids = [row[0] for row in db.execute("SELECT id FROM users WHERE is_admin = 0")]
+
+    db.executemany("INSERT INTO bus_operators (name, rating) VALUES (?, ?)",
+                   [(f"Operator {i}", round(rng.uniform(3.5, 5.0), 1)) for i in range(8)])
+    op_ids = [row[0] for row in db.execute("SELECT id FROM bus_operators")]
+    db.executemany("INSERT INTO buses (operator_id, bus_number, bus_type) VALUES (?, ?, ?)",
+                   [(rng.choice(op_ids), f"BUS-{i:04d}", 'Volvo Multi-Axle AC Sleeper') for i in range(max(30, routes))])
+    bus_ids = [row[0] for row in db.execute("SELECT id FROM buses")]
+
+    pairs = [(a, b) for a in CITIES for b in CITIES if a != b]
+    rng.shuffle(pairs)
+    db.executemany("INSERT INTO routes (from_city, to_city, duration) VALUES (?, ?, '5h 00m')",
+                   [pairs[i % len(pairs)] for i in range(routes)])
+    route_rows = db.execute("SELECT id, from_city, to_city FROM routes").fetchall()
+
+    today = datetime.now().date()
+    dates = [(today + timedelta(days=d)).strftime("%Y-%m-%d") for d in range(days)]
+    schedules = []
+    for route_id, _, _ in route_rows:
+        for date in dates:
+            for _ in range(rng.randint(3, 6)):
+                hour = rng.randint(5, 23)
+                schedules.append((rng.choice(bus_ids), route_id, f"{hour:02}:00", f"{(hour + 5) % 24:02}:00",
+                                  date, rng.randint(400, 2500)))
+    db.executemany('''
+        INSERT INTO schedules (bus_id, route_id, departure_time, arrival_time, travel_date, price)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', schedules)
+    schedule_ids = [row[0] for row in db.execute("SELECT id FROM schedules")]
+
+    # Bookings: leave the last few seats of every bus free for the booking benchmark
+    booking_id = db.execute("SELECT COALESCE(MAX(id), 0) FROM bookings").fetchone()[0]
+    bookings, passengers = [], []
+    for sid in schedule_ids:
+        free = SEATS[:-8]
+        rng.shuffle(free)
+        for _ in range(bookings_per_schedule):
+            n = rng.randint(1, 3)
+            if len(free) < n:
+                break
+            seats, free = free[:n], free[n:]
+            booking_id += 1
+            bookings.append((booking_id, rng.choice(user_ids), sid, json.dumps(seats), 1000.0 * n))
+            passengers.extend((booking_id, seat, f"Passenger {booking_id}-{seat}", rng.randint(5, 80),
+                               rng.choice(['Male', 'Female']), f"8{booking_id:09d}") for seat in seats)
+    db.executemany("INSERT INTO bookings (id, user_id, schedule_id, seats, total_amount) VALUES (?, ?, ?, ?, ?)", bookings)
+    db.executemany(autobus.INSERT_PASSENGER_SQL, passengers)
+    db.commit()
+    db.close()
+
+    # Derived tables (fare calendar) through the app's own code path
+    with autobus.app.app_context():
+        conn = autobus.get_db()
+        autobus.refresh_fare_calendar(conn)
+        conn.commit()
+
+    return {
+        "routes": [(f, t) for _, f, t in route_rows],
+        "dates": dates,
+        "schedule_ids": schedule_ids,
+        "user_ids": user_ids,
+        "counts": {"routes": len(route_rows), "schedules": len(schedule_ids), "bookings": len(bookings),
+                   "passengers": len(passengers), "users": len(user_ids)},
+    }
+
+
+# --- Measurement ---
+def _client(user_id, email='bench@bench.local', name='Bench'):
+    client = autobus.app.test_client()
+    with client.session_transaction() as s:
+        s['user_id'] = user_id
+        s['user_email'] = email
+        s['user_name'] = name
+    return client
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    k = min(len(sorted_values) - 1, max(0, round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+def run_scenario(make_request, requests, threads, clients):
+    """Fire `requests` calls of make_request(client, rng) spread across `threads` threads."""
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+    per_thread = [requests // threads + (1 if i < requests % threads else 0) for i in range(threads)]
+
+    def worker(i):
+        rng = random.Random(1000 + i)
+        client = clients[i % len(clients)]
+        local_lat, local_status = [], {}
+        for _ in range(per_thread[i]):
+            start = time.perf_counter()
+            status = make_request(client, rng)
+            local_lat.append(time.perf_counter() - start)
+            local_status[status] = local_status.get(status, 0) + 1
+        with lock:
+            latencies.extend(local_lat)
+            for k, v in local_status.items():
+                statuses[k] = statuses.get(k, 0) + v
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    wall = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    wall = time.perf_counter() - wall
+
+    latencies.sort()
+    ms = lambda v: round(v * 1000, 3) if v is not None else None
+    return {
+        "requests": len(latencies),
+        "threads": threads,
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else None,
+        "latency_ms": {"mean": ms(sum(latencies) / len(latencies)) if latencies else None,
+                       "p50": ms(_percentile(latencies, 50)), "p90": ms(_percentile(latencies, 90)),
+                       "p99": ms(_percentile(latencies, 99)), "max": ms(latencies[-1] if latencies else None)},
+        "status_codes": {str(k): v for k, v in sorted(statuses.items())},
+    }
+
+def run_double_booking_race(data, threads, rounds):
+    """All threads book the same free seat at once. More than one winner is a double booking."""
+    results = {"rounds": rounds, "threads": threads, "double_bookings": 0, "status_codes": {}}
+    clients = [_client(uid) for uid in data['user_ids'][:threads]]
+    for r in range(rounds):
+        sid = data['schedule_ids'][r % len(data['schedule_ids'])]
+        seat = RACE_SEATS[(r // len(data['schedule_ids'])) % len(RACE_SEATS)]
+        barrier = threading.Barrier(threads)
+        codes = []
+
+        def attempt(client):
+            barrier.wait()
+            codes.append(client.post('/api/book', json={"scheduleId": sid, "seats": [seat]}).status_code)
+
+        pool = [threading.Thread(target=attempt, args=(c,)) for c in clients]
+        for t in pool:
+            t.start()
+        for t in pool:
+            t.join()
+        winners = codes.count(200)
+        results["double_bookings"] += max(0, winners - 1)
+        for code in codes:
+            results["status_codes"][str(code)] = results["status_codes"].get(str(code), 0) + 1
+    return results
+
+def run_benchmarks(data, threads, requests):
+    user_clients = [_client(uid) for uid in data['user_ids'][:threads]]
+    with sqlite3.connect(autobus.DB_NAME) as db:
+        admin_id = db.execute("SELECT id FROM users WHERE is_admin = 1").fetchone()[0]
+    admin_clients = [_client(admin_id, 'admin@bench.local', 'Bench Admin')]
+
+    def search(client, rng):
+        f, t = rng.choice(data['routes'])
+        return client.get('/api/search', query_string={"from": f, "to": t, "date": rng.choice(data['dates'])}).status_code
+
+    def seat_map(client, rng):
+        return client.get(f"/api/seats/{rng.choice(data['schedule_ids'])}").status_code
+
+    def book(client, rng):
+        return client.post('/api/book', json={"scheduleId": rng.choice(data['schedule_ids']),
+                                              "seats": [rng.choice(BOOK_SEATS)]}).status_code
+
+    def my_bookings(client, rng):
+        return client.get('/api/my-bookings').status_code
+
+    def admin_stats(client, rng):
+        return client.get('/api/admin/stats').status_code
+
+    return {
+        "search": run_scenario(search, requests, threads, user_clients),
+        "seat_map": run_scenario(seat_map, requests, threads, user_clients),
+        "my_bookings": run_scenario(my_bookings, requests, threads, user_clients),
+        "admin_stats": run_scenario(admin_stats, requests, threads, admin_clients),
+        "book": run_scenario(book, max(1, requests // 5), threads, user_clients),
+        "double_booking_race": run_double_booking_race(data, threads, rounds=20),
+    }
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="AutoBusBook performance benchmarks")
+    parser.add_argument('--routes', type=int, default=22)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--bookings-per-schedule', type=int, default=10)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=500, help='Requests per read scenario')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--db', default=None, help='Where to build the benchmark database (default: temp file)')
+    parser.add_argument('--out', default=None, help='Write JSON results here instead of stdout')
+    args = parser.parse_args(argv)
+
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix='autobus-bench-'), 'bench.db')
+    autobus.app.config['TESTING'] = True
+
+    # App logging (mock emails etc.) goes to stderr so stdout stays valid JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        start = time.perf_counter()
+        data = generate_db(db_path, args.routes, args.days, args.bookings_per_schedule, args.users, args.seed)
+        build_seconds = time.perf_counter() - start
+        results = run_benchmarks(data, args.threads, args.requests)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec='seconds'),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "scale": {"routes": args.routes, "days": args.days, "bookings_per_schedule": args.bookings_per_schedule,
+                      "users": args.users, "seed": args.seed},
+            "threads": args.threads,
+            "data": data['counts'],
+            "build_seconds": round(build_seconds, 3),
+        },
+        "results": results,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    return report
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
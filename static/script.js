@@ -573,7 +573,7 @@ if (window.location.pathname.startsWith('/ticket/')) {
             if (qrEl && typeof QRCode !== 'undefined') {
                 qrEl.innerHTML = "";
                 new QRCode(qrEl, {
-                    text: `PNR:AB-${ticket.id}|AMT:${ticket.total_amount}`,
+                    text: ticket.qr || `PNR:AB-${ticket.id}|AMT:${ticket.total_amount}`,
                     width: 100,
                     height: 100
                 });